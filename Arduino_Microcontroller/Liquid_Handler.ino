@@ -15,6 +15,9 @@ int sizeoftitanxstates = 5;
 int valvepin = 7;
 int valvestate = 0;
 int pumpstate = 0;
+// setvalve polls the TitanX position every valvepollms until it reaches the target, giving up after valvetimeoutms
+unsigned long valvetimeoutms = 5000;
+int valvepollms = 20;
 
 void setup() {
   Serial.begin(9600);
@@ -38,48 +41,25 @@ void loop() {
     String state = "";
     state = Serial.readStringUntil('\r\n');
     if (state.length() > 0) {
-  //    First, read the command number
-        char cmd = state.charAt(0);
-        if (cmd == '0' and state.length() == 1)
-          {
-            scanaddresses(titanxstates);
-            printtitanxstates();
-            Serial.print(valvestate);
-            Serial.print(";");
-            Serial.println(pumpstate);
-          }
-        if (cmd == '1' and state.length() == 3)
-          {
-            int addrint = state.substring(1,2).toInt();
-            int newaddrint = state.substring(2,3).toInt();
-            setaddress(addrint, newaddrint);
-          }
-        if (cmd == '2' and state.length() == 4)
-          {
-            int addrint = state.substring(1,2).toInt();
-            int valveint = state.substring(2,4).toInt();
-            setvalve(addrint, valveint);
-          }
-        
-        if (cmd == '3' and state.length() == 5)
-          {
-            pumpstate = state.substring(1,5).toInt();
-            dac.setVoltage(pumpstate, false);
-          }
-        if (cmd == '4' and state.length() == 2)
+  //    Commands sent as #<seq>:<cmd> are acknowledged with <seq>:OK or <seq>:ERR once they finish
+        if (state.charAt(0) == '#')
           {
-            valvestate = state.substring(1,2).toInt();
-            if (valvestate == 0)
+            int sep = state.indexOf(':');
+            String seq = state.substring(1,sep);
+            boolean ok = (sep > 1) and runcommand(state.substring(sep+1));
+            Serial.print(seq);
+            if (ok)
             {
-              digitalWrite(valvepin, LOW);
+              Serial.println(":OK");
+            }
+            else
+            {
+              Serial.println(":ERR");
             }
-            else if (valvestate == 1) {
-              digitalWrite(valvepin, HIGH);
-            }                       
           }
-         if (cmd == '5' and state.length() == 1)
+        else
           {
-            Serial.print("MARLIN");
+            runcommand(state);
           }
     }
     else
@@ -91,6 +71,120 @@ void loop() {
   }
 }
 
+boolean runcommand(String state){
+  //    First, read the command number
+  if (state.length() == 0)
+    {
+      return false;
+    }
+  char cmd = state.charAt(0);
+  if (cmd == '0' and state.length() == 1)
+    {
+      scanaddresses(titanxstates);
+      printtitanxstates();
+      Serial.print(valvestate);
+      Serial.print(";");
+      Serial.println(pumpstate);
+      return true;
+    }
+  if (cmd == '1' and state.length() == 3)
+    {
+      int addrint = state.substring(1,2).toInt();
+      int newaddrint = state.substring(2,3).toInt();
+      setaddress(addrint, newaddrint);
+      return true;
+    }
+  if (cmd == '2' and state.length() == 4)
+    {
+      int addrint = state.substring(1,2).toInt();
+      int valveint = state.substring(2,4).toInt();
+      return setvalve(addrint, valveint);
+    }
+  
+  if (cmd == '3' and state.length() == 5)
+    {
+      pumpstate = state.substring(1,5).toInt();
+      dac.setVoltage(pumpstate, false);
+      return true;
+    }
+  if (cmd == '4' and state.length() == 2)
+    {
+      valvestate = state.substring(1,2).toInt();
+      if (valvestate == 0)
+      {
+        digitalWrite(valvepin, LOW);
+      }
+      else if (valvestate == 1) {
+        digitalWrite(valvepin, HIGH);
+      }
+      return true;
+    }
+  if (cmd == '5' and state.length() == 1)
+    {
+      Serial.print("MARLIN");
+      return true;
+    }
+  //    Batched state: 6 + valve (1) + pump (4) + five 2-digit TitanX positions (00 leaves a valve unchanged)
+  if (cmd == '6' and state.length() == 16)
+    {
+      int newvalvestate = state.substring(1,2).toInt();
+      int newpumpstate = state.substring(2,6).toInt();
+      int newtitanxstates[] = {0,0,0,0,0};
+      boolean valid = (newvalvestate == 0 or newvalvestate == 1) and (newpumpstate >= 0 and newpumpstate <= 4095);
+      for(int i = 0; i < sizeoftitanxstates; i++)
+      {
+        newtitanxstates[i] = state.substring(6+2*i,8+2*i).toInt();
+        if (newtitanxstates[i] < 0 or newtitanxstates[i] > 12)
+        {
+          valid = false;
+        }
+      }
+      if (valid)
+      {
+        //    applystate returns once every moved valve has reached position, so the scan reports settled positions
+        valid = applystate(newvalvestate, newpumpstate, newtitanxstates);
+        scanaddresses(titanxstates);
+        printtitanxstates();
+        Serial.print(valvestate);
+        Serial.print(";");
+        Serial.println(pumpstate);
+      }
+      else
+      {
+        Serial.println("ERR");
+      }
+      return valid;
+    }
+  if (cmd == '7' and state.length() == 1)
+    {
+      Serial.println("MARLIN3");
+      return true;
+    }
+  return false;
+}
+
+boolean applystate(int newvalvestate, int newpumpstate, int newtitanxstates[]){
+  boolean reached = true;
+  valvestate = newvalvestate;
+  if (valvestate == 0)
+  {
+    digitalWrite(valvepin, LOW);
+  }
+  else {
+    digitalWrite(valvepin, HIGH);
+  }
+  pumpstate = newpumpstate;
+  dac.setVoltage(pumpstate, false);
+  for(int i = 0; i < sizeoftitanxstates; i++)
+  {
+    if (newtitanxstates[i] != 0)
+    {
+      reached = setvalve(i, newtitanxstates[i]) and reached;
+    }
+  }
+  return reached;
+}
+
 void printtitanxstates(){
   Serial.print("[");
   for(int i = 0; i < sizeoftitanxstates-1; i++)
@@ -103,49 +197,64 @@ void printtitanxstates(){
 }
 
 void scanaddresses(int titanxstates[]){
+  for(int addrint = 0; addrint < sizeoftitanxstates; addrint++ ){
+    titanxstates[addrint] = readvalve(addrint);
+  }
+}
+
+int readvalve(int addrint){
   byte writeaddress, readaddress, incr, command, value, wchk, wack, rval, rchk;
   boolean getbyte = true;
-  int addrint, readint;
-  for(addrint = 0; addrint < sizeoftitanxstates; addrint++ ){
-    writeaddress = addresslist[addrint];
-    incr = 0x01;
-    readaddress = writeaddress + incr;
-    command = 0x53;
-    value = 0x00;
-    wchk = (writeaddress ^ command ^ value);
+  writeaddress = addresslist[addrint];
+  incr = 0x01;
+  readaddress = writeaddress + incr;
+  command = 0x53;
+  value = 0x00;
+  wchk = (writeaddress ^ command ^ value);
 
-    I2c.start();
-    wack = I2c.sendAddress(writeaddress);
-        
-    if (wack == 0) {
-      I2c.sendByte(command);
-      I2c.sendByte(value);
-      I2c.sendByte(wchk);
-      I2c.stop();
+  I2c.start();
+  wack = I2c.sendAddress(writeaddress);
       
-      I2c.start();
-      I2c.sendAddress(readaddress);
-      I2c.receiveByte(getbyte, &rval);
-      I2c.receiveByte(getbyte, &rchk);
-      I2c.stop();
+  if (wack == 0) {
+    I2c.sendByte(command);
+    I2c.sendByte(value);
+    I2c.sendByte(wchk);
+    I2c.stop();
+    
+    I2c.start();
+    I2c.sendAddress(readaddress);
+    I2c.receiveByte(getbyte, &rval);
+    I2c.receiveByte(getbyte, &rchk);
+    I2c.stop();
 
-//      Serial.print("Address: ");
-//      String addrstring = String(addrint);
-//      Serial.print(addrstring);
-//      Serial.print(" | Valve State: ");
-//      String valvestring = String(rval);
-//      Serial.println(valvestring);
-      titanxstates[addrint] = rval;
+//    Serial.print("Address: ");
+//    String addrstring = String(addrint);
+//    Serial.print(addrstring);
+//    Serial.print(" | Valve State: ");
+//    String valvestring = String(rval);
+//    Serial.println(valvestring);
 
-      I2c.start();
-      wack = I2c.sendAddress(writeaddress);
-      I2c.stop();
-    }
-    else {
-      titanxstates[addrint] = 0;
-      I2c.stop();
+    I2c.start();
+    wack = I2c.sendAddress(writeaddress);
+    I2c.stop();
+    return rval;
+  }
+  else {
+    I2c.stop();
+    return 0;
+  }
+}
+
+boolean waitforvalve(int addrint, int valveint){
+  unsigned long tstart = millis();
+  while (millis() - tstart < valvetimeoutms) {
+    if (readvalve(addrint) == valveint) {
+      titanxstates[addrint] = valveint;
+      return true;
     }
+    delay(valvepollms);
   }
+  return false;
 }
 
 
@@ -164,7 +273,7 @@ void setaddress(int addrint, int newaddrint){
   I2c.stop();
 }
 
-void setvalve(int addrint, int valveint){
+boolean setvalve(int addrint, int valveint){
   byte address, command, chk, ack, valve;
   int iter;
   address = addresslist[addrint];
@@ -180,10 +289,12 @@ void setvalve(int addrint, int valveint){
       I2c.sendByte(valve);
       I2c.sendByte(chk);
       I2c.stop();
-      break;
+      //    The write is only a request; OK is sent once the valve reports the new position
+      return waitforvalve(addrint, valveint);
     }
     else {
       I2c.stop();
     }
   }
+  return false;
 }
@@ -1,3 +1,9 @@
 from .scope import *
 from .handler import *
-from .scheduler import *
\ No newline at end of file
+from .scheduler import *
+from .protocol import *
+from .storage import *
+from .profiler import *
+from .sim import *
+from .aio import *
+from .reader import *
\ No newline at end of file
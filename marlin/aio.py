@@ -0,0 +1,112 @@
+import time
+import asyncio
+import threading
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
+async def call_monitor(fn,elapsed,total):
+    if asyncio.iscoroutinefunction(fn):
+        await fn(elapsed,total)
+    else:
+        fn(elapsed,total)
+
+async def wait_for_async(num_secs,monitors=[],progress=None,progress_interval=60.):
+    ### Same deadline logic as scheduler.wait_for, but yields to the event loop; cancel the task to stop it ###
+    t_start = time.monotonic()
+    deadline = t_start + num_secs
+    if progress is not None:
+        monitors = list(monitors) + [(progress_interval,progress)]
+    next_calls = [t_start + interval for interval,fn in monitors]
+
+    while True:
+        now = time.monotonic()
+        for monitor_num,(interval,fn) in enumerate(monitors):
+            if now >= next_calls[monitor_num] and now < deadline:
+                await call_monitor(fn,now - t_start,num_secs)
+                next_calls[monitor_num] += interval
+        now = time.monotonic()
+        if now >= deadline:
+            return True
+        await asyncio.sleep(max(min([deadline] + next_calls) - now,0.))
+
+class asyncDevice:
+    def __init__(self,device,lock=None,name="device"):
+        ### One worker thread per device serializes its calls the way the hardware would; lock is shared with any scheduler using it ###
+        self.device = device
+        self.lock = threading.RLock() if lock is None else lock
+        self.executor = ThreadPoolExecutor(max_workers=1,thread_name_prefix=name)
+
+    async def call(self,fn,*args,**kwargs):
+        def locked_call():
+            with self.lock:
+                return fn(*args,**kwargs)
+        return await asyncio.get_running_loop().run_in_executor(self.executor,locked_call)
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+class asyncHandler(asyncDevice):
+    def __init__(self,handler,lock=None):
+        super().__init__(handler,lock=lock,name="handler")
+
+    async def sendstate(self,valvestate,pumpstate,titanxstates):
+        return await self.call(self.device.sendstate,valvestate,pumpstate,titanxstates)
+
+    async def set_valve_state(self,titanx_state_name,valvestate):
+        return await self.call(self.device.set_valve_state,titanx_state_name,valvestate)
+
+    async def set_pump_state(self,pumpstate):
+        return await self.call(self.device.set_pump_state,pumpstate)
+
+    async def readback(self):
+        return await self.call(self.device.readback)
+
+class asyncScope(asyncDevice):
+    def __init__(self,scope,lock=None):
+        super().__init__(scope,lock=lock,name="scope")
+
+    async def snap_image(self):
+        return await self.call(self.device.snap_image)
+
+    async def move_to(self,x_coord,y_coord):
+        return await self.call(self.device.move_to,x_coord,y_coord)
+
+    async def multipoint_aq(self,grid_coords,config_list,timepoint,**aq_kwargs):
+        return await self.call(self.device.multipoint_aq,grid_coords,config_list,timepoint,**aq_kwargs)
+
+class asyncScheduler:
+    def __init__(self,scheduler,handler=None,scope=None):
+        ### Runs a FISH_scheduler off the event loop; passing the asyncHandler/asyncScope wrappers shares their locks with it ###
+        self.scheduler = scheduler
+        if handler is not None:
+            self.scheduler.fluidics_lock = handler.lock
+        if scope is not None:
+            self.scheduler.scope_lock = scope.lock
+        self.executor = ThreadPoolExecutor(max_workers=1,thread_name_prefix="scheduler")
+
+    async def call(self,fn,*args,**kwargs):
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor,partial(fn,*args,**kwargs))
+        except asyncio.CancelledError:
+            ### The worker thread can't be interrupted directly, so stop it at its next wait ###
+            self.scheduler.cancel()
+            raise
+
+    async def run(self,grid_coords=None,num_cycles=10,fov_ids=None,resume=False):
+        return await self.call(self.scheduler.run,grid_coords=grid_coords,num_cycles=num_cycles,fov_ids=fov_ids,resume=resume)
+
+    async def run_protocol(self,protocol,grid_coords=None,fov_ids=None,optimize=True,image_secs=0.):
+        return await self.call(self.scheduler.run_protocol,protocol,grid_coords=grid_coords,fov_ids=fov_ids,optimize=optimize,image_secs=image_secs)
+
+    def status(self):
+        last_wait = self.scheduler.wait_log[-1] if len(self.scheduler.wait_log) > 0 else None
+        return {"phase":self.scheduler.step_prefix,"step_num":self.scheduler.step_num,"last_wait":last_wait,\
+                "cancelled":self.scheduler.cancel_event.is_set()}
+
+    async def report(self,task,interval=60.,fn=print):
+        while not task.done():
+            fn(self.status())
+            await asyncio.sleep(interval)
+
+    def close(self):
+        self.executor.shutdown(wait=False)
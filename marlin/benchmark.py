@@ -0,0 +1,92 @@
+import os
+import sys
+import json
+import time
+import tempfile
+from .sim import simCore,simArduino
+from .scope import scopeCore
+from .handler import handlerCore
+from .scheduler import FISH_scheduler
+
+default_configpath = os.path.join(os.path.dirname(os.path.abspath(__file__)),"..","Micromanager_Configs","Ti6_Iris15_Standard.cfg")
+
+### Metrics where larger is better; everything else is a duration ###
+higher_is_better = {"multipoint_fovs_per_sec","sendstate_per_sec"}
+
+def sim_scope(configpath=default_configpath,latencies={},time_scale=1.,**scope_kwargs):
+    mmc = simCore(latencies=latencies,time_scale=time_scale)
+    ### scopeCore's fixed PFS settle sleeps are real time, so they are scaled along with the simulated devices ###
+    scope_kwargs.setdefault("pfs_settle_secs",0.25*time_scale)
+    return scopeCore(configpath,os.devnull,camera_name="PVCamera",shutter_name="Celesta",xystage_name="XYStage",focus_name="ZDrive",\
+                     mmc=mmc,**scope_kwargs)
+
+def sim_handler(latencies={},time_scale=1.,port="COM3",**handler_kwargs):
+    arduino = simArduino(port=port,latencies=latencies,time_scale=time_scale)
+    handler = handlerCore(comport=port,serial_class=arduino.serial_class(),port_cache=None,**handler_kwargs)
+    return handler,arduino
+
+def bench_multipoint(num_col=5,num_row=4,config_list=["BF","Cy5"],time_scale=0.01,configpath=default_configpath,scope_kwargs={},**aq_kwargs):
+    scope = sim_scope(configpath=configpath,time_scale=time_scale,**scope_kwargs)
+    grid_coords = scope.set_grid(num_col,num_row)
+    with tempfile.TemporaryDirectory() as output_folder:
+        ti = time.perf_counter()
+        scope.multipoint_aq(grid_coords,config_list,1,output_folder=output_folder + "/",**aq_kwargs)
+        t_elapsed = time.perf_counter()-ti
+    return {"multipoint_secs":t_elapsed,"multipoint_fovs_per_sec":len(grid_coords)/t_elapsed}
+
+def bench_sendstate(num_states=4,time_scale=1.,**handler_kwargs):
+    handler,arduino = sim_handler(time_scale=time_scale,**handler_kwargs)
+    state_names = ["Probe " + str(state_num+1) for state_num in range(num_states)]
+    ti = time.perf_counter()
+    for state_name in state_names:
+        handler.set_valve_state(state_name,0)
+    t_elapsed = time.perf_counter()-ti
+    return {"sendstate_secs":t_elapsed/num_states,"sendstate_per_sec":num_states/t_elapsed}
+
+def bench_scheduler(num_cycles=2,num_col=2,num_row=2,config_list=["BF","Cy5"],time_scale=0.001,configpath=default_configpath,**scheduler_kwargs):
+    scope = sim_scope(configpath=configpath,time_scale=time_scale)
+    handler,arduino = sim_handler(time_scale=time_scale)
+    grid_coords = scope.set_grid(num_col,num_row)
+    with tempfile.TemporaryDirectory() as output_folder:
+        scheduler = FISH_scheduler(handler,scope,channels=config_list,output_folder=output_folder + "/",\
+                                   wait_fn=lambda num_secs: time.sleep(num_secs*time_scale),**scheduler_kwargs)
+        ti = time.perf_counter()
+        scheduler.run(grid_coords=grid_coords,num_cycles=num_cycles)
+        t_elapsed = time.perf_counter()-ti
+    return {"scheduler_secs":t_elapsed}
+
+def run_benchmarks(baseline_path=None,tolerance=0.25):
+    results = {}
+    results.update(bench_multipoint())
+    results.update(bench_sendstate())
+    results.update(bench_scheduler())
+
+    regressions = []
+    if baseline_path is not None and os.path.exists(baseline_path):
+        with open(baseline_path,"r") as infile:
+            baseline = json.load(infile)
+        for key,value in results.items():
+            if key not in baseline:
+                continue
+            if key in higher_is_better:
+                regressed = value < baseline[key]*(1.-tolerance)
+            else:
+                regressed = value > baseline[key]*(1.+tolerance)
+            if regressed:
+                regressions.append(key)
+    return results,regressions
+
+def save_baseline(results,baseline_path):
+    with open(baseline_path,"w") as outfile:
+        json.dump(results,outfile,indent=2)
+
+if __name__ == "__main__":
+    baseline_path = sys.argv[1] if len(sys.argv) > 1 else None
+    results,regressions = run_benchmarks(baseline_path=baseline_path)
+    for key,value in results.items():
+        print(key + ": " + str(round(value,4)))
+    if len(regressions) > 0:
+        print("Regressed: " + ", ".join(regressions))
+        sys.exit(1)
+    if baseline_path is not None and not os.path.exists(baseline_path):
+        save_baseline(results,baseline_path)
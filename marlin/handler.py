@@ -1,11 +1,44 @@
+import os
 import serial
 import serial.tools.list_ports
 import time
 from time import sleep
+from concurrent.futures import ThreadPoolExecutor
 from .scheduler import wait_for
 
+### USB vendor IDs of Arduino boards and the common USB-serial bridges on clones (CH340, FTDI, CP210x) ###
+arduino_vids = {0x2341,0x2A03,0x1A86,0x0403,0x10C4}
+default_port_cache = os.path.join(os.path.expanduser("~"),".marlin_port")
+### Matches valvetimeoutms in Liquid_Handler.ino: the firmware acks a TitanX move only once it is in position, or gives up after this long ###
+valve_timeout = 5.
+
+def candidate_ports(vids=arduino_vids):
+    ports = list(serial.tools.list_ports.comports())
+    matched = [port.device for port in ports if port.vid in vids]
+    if len(matched) > 0:
+        return matched
+    if len(ports) > 0:
+        return [port.device for port in ports]
+    return ['COM%s' % (i + 1) for i in range(256)]
+
+def read_port_cache(port_cache):
+    if port_cache is None or not os.path.exists(port_cache):
+        return None
+    with open(port_cache,"r") as infile:
+        return infile.read().strip()
+
+def write_port_cache(port_cache,comport):
+    if port_cache is None:
+        return
+    try:
+        with open(port_cache,"w") as outfile:
+            outfile.write(comport)
+    except OSError:
+        pass
+
 class handlerCore:
-    def __init__(self,handshakes=2,default_state="PFA(half-MeAc)",comport=None):
+    def __init__(self,handshakes=2,default_state="PFA(half-MeAc)",comport=None,serial_class=None,protocol="auto",command_retries=3,ack_timeout=valve_timeout+1.,\
+                 port_cache=default_port_cache,state_cache=True,verify_interval=60.):
         self.valvestate = 0
         self.pumpstate = 0
         self.titanxstates = [0 for i in range(5)]
@@ -22,8 +55,25 @@ class handlerCore:
                         "Cleave" : [0,1,1,12,0]}
         self.titanx_states_inv = {tuple(val):key for key,val in self.titanx_states.items()}
         self.stage_valve_state_dict = {0:'Stage',1:'Waste'}
+        self.serial_class = serial.Serial if serial_class is None else serial_class
+        self.command_retries = command_retries
+        self.ack_timeout = ack_timeout
+        self.seq = 0
+        ### Last state confirmed by a handshake; requests matching it are skipped until verify_interval elapses ###
+        self.state_cache = state_cache
+        self.verify_interval = verify_interval
+        self.verified_state = None
+        self.verified_time = 0.
+        self.transitions_sent = 0
+        self.transitions_skipped = 0
+        self.transitions_verified = 0
         
-        self.connect(comport=comport)
+        self.connect(comport=comport,port_cache=port_cache)
+        self.firmware_version = self.detect_firmware_version()
+        if protocol == "auto":
+            self.protocol = "batched" if self.firmware_version >= 2 else "legacy"
+        else:
+            self.protocol = protocol
         self.set_valve_state(default_state,0)
         self.set_pump_state(0)
         print("Handler Ready.")
@@ -32,7 +82,7 @@ class handlerCore:
         try:
             ti = time.time()
             no_timeout = True
-            s = serial.Serial(comport,9600,timeout=0.5)
+            s = self.serial_class(comport,9600,timeout=0.5)
             readcmd = "5\n".encode('ascii')
             while no_timeout:
                 s.write(readcmd)
@@ -50,23 +100,30 @@ class handlerCore:
         except (OSError, serial.SerialException):
             return False 
         
-    def connect(self,comport=None,connect_code=b"MARLIN",timeout=10.):
+    def probe_ports(self,ports,connect_code=b"MARLIN",timeout=3.):
+        if len(ports) == 1:
+            return [port for port in ports if self.get_heartbeat(port,connect_code=connect_code,timeout=timeout)]
+        with ThreadPoolExecutor(max_workers=min(len(ports),32)) as executor:
+            heartbeats = list(executor.map(lambda port: self.get_heartbeat(port,connect_code=connect_code,timeout=timeout),ports))
+        return [port for port,heartbeat in zip(ports,heartbeats) if heartbeat]
+
+    def connect(self,comport=None,connect_code=b"MARLIN",timeout=10.,probe_timeout=3.,port_cache=default_port_cache):
+        ### Try the last known-good port first, then probe enumerated (Arduino VID first) ports in parallel ###
         if comport == None:
-            ports = ['COM%s' % (i + 1) for i in range(256)]
+            result = []
+            cached_port = read_port_cache(port_cache)
+            if cached_port is not None:
+                result = self.probe_ports([cached_port],connect_code=connect_code,timeout=probe_timeout)
+            if len(result) == 0:
+                result = self.probe_ports(candidate_ports(),connect_code=connect_code,timeout=probe_timeout)
         else:
-            ports = [comport]
-            
-        result = []
-        for port in ports:
-            heartbeat = self.get_heartbeat(port,connect_code=connect_code,timeout=timeout)
-            if heartbeat:
-                result.append(port)
+            result = self.probe_ports([comport],connect_code=connect_code,timeout=timeout)
         if len(result) == 0:
             raise ValueError("No MARLIN detected.")
         elif len(result) == 1:
             ti = time.time()
             no_timeout = True
-            self.serial_handle = serial.Serial(result[0], 9600, timeout=0.5)
+            self.serial_handle = self.serial_class(result[0], 9600, timeout=0.5)
             readcmd = "5\n".encode('ascii')
             while no_timeout:
                 self.serial_handle.write(readcmd)
@@ -78,12 +135,25 @@ class handlerCore:
                     no_timeout = False
             if returnedstr == connect_code:
                 self.serial_handle.timeout = 10.
+                write_port_cache(port_cache,result[0])
                 print("Connected.")
             else:
                 raise ValueError("MARLIN connection timeout.")
         else:
             raise ValueError("More than one MARLIN detected.")
         
+    def detect_firmware_version(self,timeout=0.5):
+        ### '7' answers MARLIN<version>: 2 adds the batched state command, 3 adds acknowledged commands; older firmware stays silent ###
+        self.serial_handle.reset_input_buffer()
+        self.serial_handle.timeout = timeout
+        self.serial_handle.write("7\n".encode('ascii'))
+        returnedstr = self.serial_handle.read_until().strip()
+        self.serial_handle.timeout = 10.
+        self.serial_handle.reset_input_buffer()
+        if returnedstr.startswith(b"MARLIN") and returnedstr[6:].isdigit():
+            return int(returnedstr[6:])
+        return 1
+
     def updatestate(self,valvestate,pumpstate,titanxstates):
         self.valvestate = valvestate
         self.pumpstate = pumpstate
@@ -98,45 +168,151 @@ class handlerCore:
         print(valve_name_str + " flowing to " + stage_valve_state_str + " at " + pump_state_string + " Volts (" + pump_state_perc + "%)")
         
         
-    def sendstate(self,valvestate,pumpstate,titanxstates):
-        
-        self.updatestate(valvestate,pumpstate,titanxstates)
-        no_handshake = True
-        handshake_failed = False
-        handshake_attempts = 0
+    def checkstr(self):
+        return ("[" + ",".join([str(state) for state in self.titanxstates]) + "];" + str(self.valvestate) + ";" + str(self.pumpstate)).encode("utf8")
 
-        while no_handshake:
-            valvestr = "4" + str(self.valvestate)
+    def parse_state(self,returnedstr):
+        try:
+            titanxstr,valvestr,pumpstr = returnedstr.strip().decode("ascii").split(";")
+            titanxstates = [int(state) for state in titanxstr.strip("[]").split(",")]
+            return titanxstates,int(valvestr),int(pumpstr)
+        except ValueError:
+            return None
+
+    def state_commands(self,readstate=None):
+        ### With a parsed readback, only the commands for fields that differ from the requested state are returned ###
+        if readstate is not None:
+            read_titanxstates,read_valvestate,read_pumpstate = readstate
+        cmdlist = []
+
+        if readstate is None or read_valvestate != self.valvestate:
+            cmdlist.append("4" + str(self.valvestate))
+        if readstate is None or read_pumpstate != self.pumpstate:
             pumpstr = str(self.pumpstate)
-            pumpstr = "3" + ("0"*(4-len(pumpstr)) + pumpstr)
+            cmdlist.append("3" + ("0"*(4-len(pumpstr)) + pumpstr))
+
+        for titannum,titanxstate in enumerate(self.titanxstates):
+            if titanxstate != 0 and (readstate is None or read_titanxstates[titannum] != titanxstate):
+                titanxstr = str(titanxstate)
+                cmdlist.append("2" + str(titannum) + ("0"*(2-len(titanxstr)) + titanxstr))
+        return cmdlist
 
-            titanxstrlist = []
+    def readback(self):
+        readcmd = "0\n".encode('ascii')
+        self.serial_handle.write(readcmd)
+        return self.serial_handle.read_until()[:-1]
 
-            for titannum,titanxstate in enumerate(self.titanxstates):
-                if titanxstate != 0:
-                    titanxstr = str(titanxstate)
-                    titanxstr = "2" + str(titannum) + ("0"*(2-len(titanxstr)) + titanxstr)
-                    titanxstrlist.append(titanxstr)
+    def send_command(self,cmd):
+        ### Sends one acknowledged command, retrying only that command until it is acknowledged OK ###
+        ### ack_timeout outlasts the firmware's own valve timeout, so a retry is only sent once the previous attempt has been answered or abandoned ###
+        ### A late OK for an earlier attempt of the same command still counts, since the command is idempotent ###
+        timeout = self.serial_handle.timeout
+        self.serial_handle.timeout = self.ack_timeout
+        sent = set()
+        try:
+            for attempt in range(self.command_retries):
+                self.seq = (self.seq + 1) % 100
+                seqstr = str(self.seq).encode('ascii')
+                sent.add(seqstr)
+                self.serial_handle.write(("#" + str(self.seq) + ":" + cmd + '\n').encode('ascii'))
+                ti = time.time()
+                while time.time() - ti < self.ack_timeout:
+                    returnedstr = self.serial_handle.read_until().strip()
+                    if returnedstr.endswith(b":OK") and returnedstr[:-3] in sent:
+                        return True
+                    if returnedstr == seqstr + b":ERR" or len(returnedstr) == 0:
+                        break
+        finally:
+            self.serial_handle.timeout = timeout
+        raise Exception("Command " + cmd + " failed.")
+
+    def send_ack(self,readstate=None):
+        for cmd in self.state_commands(readstate):
+            self.send_command(cmd)
+        return self.readback()
+
+    def send_legacy(self):
+        cmdlist = [""] + self.state_commands()
+
+        for cmd in cmdlist:
+            sendstr = cmd + '\n'
+            statestr = sendstr.encode('ascii')
+            self.serial_handle.write(statestr)
+            time.sleep(0.25)
+
+        return self.readback()
+
+    def send_batched(self):
+        pumpstr = str(self.pumpstate)
+        pumpstr = "0"*(4-len(pumpstr)) + pumpstr
+        titanxstr = "".join(("0"*(2-len(str(titanxstate))) + str(titanxstate)) for titanxstate in self.titanxstates)
+        sendstr = "6" + str(self.valvestate) + pumpstr + titanxstr + '\n'
+        ### The firmware moves the TitanX valves one after another and replies once all are in position ###
+        timeout = self.serial_handle.timeout
+        self.serial_handle.timeout = max(timeout,len(self.titanxstates)*valve_timeout + 1.)
+        try:
+            self.serial_handle.write(sendstr.encode('ascii'))
+            return self.serial_handle.read_until()[:-1]
+        finally:
+            self.serial_handle.timeout = timeout
+
+    def invalidate_state(self):
+        self.verified_state = None
+
+    def mark_verified(self,readstate):
+        self.verified_state = readstate
+        self.verified_time = time.time()
 
-            cmdlist = [""] + [valvestr] + [pumpstr] + titanxstrlist
+    def cached_state_matches(self,requested_state):
+        if not self.state_cache or self.verified_state != requested_state:
+            return False
+        if time.time() - self.verified_time < self.verify_interval:
+            self.transitions_skipped += 1
+            return True
+        ### Interval elapsed: a single readback confirms the hardware still holds the cached state ###
+        readstate = self.parse_state(self.readback())
+        self.serial_handle.reset_input_buffer()
+        if readstate == requested_state:
+            self.mark_verified(readstate)
+            self.transitions_verified += 1
+            return True
+        self.invalidate_state()
+        return False
 
-            for cmd in cmdlist:
-                sendstr = cmd + '\n'
-                statestr = sendstr.encode('ascii')
-                self.serial_handle.write(statestr)
-                time.sleep(0.25)
+    def counters(self):
+        return {"sent":self.transitions_sent,"skipped":self.transitions_skipped,"verified":self.transitions_verified}
 
-            readcmd = "0\n".encode('ascii')
-            self.serial_handle.write(readcmd)
-            returnedstr = self.serial_handle.read_until()[:-1]
+    def sendstate(self,valvestate,pumpstate,titanxstates):
+        requested_state = (list(titanxstates),valvestate,pumpstate)
+        if self.cached_state_matches(requested_state):
+            return
+
+        self.updatestate(valvestate,pumpstate,titanxstates)
+        self.invalidate_state()
+        self.transitions_sent += 1
+        no_handshake = True
+        handshake_attempts = 0
+        readstate = None
+
+        while no_handshake:
+            if readstate is not None and self.firmware_version >= 3:
+                returnedstr = self.send_ack(readstate)
+            elif self.protocol == "batched":
+                returnedstr = self.send_batched()
+            elif self.protocol == "ack":
+                returnedstr = self.send_ack()
+            else:
+                returnedstr = self.send_legacy()
             self.serial_handle.reset_output_buffer()
             self.serial_handle.reset_input_buffer()
-            checkstr = ("[" + ",".join([str(state) for state in self.titanxstates]) + "];" + str(self.valvestate) + ";" + str(self.pumpstate)).encode("utf8")
 
-            if returnedstr.strip() == checkstr.strip():
+            if returnedstr.strip() == self.checkstr().strip():
                 no_handshake = False
+                self.mark_verified(requested_state)
+            else:
+                readstate = self.parse_state(returnedstr)
             handshake_attempts += 1
-            if handshake_attempts >= self.handshakes:
+            if no_handshake and handshake_attempts >= self.handshakes:
                 raise Exception("Handshake failed.")
             
     def set_valve_state(self,titanx_state_name,valvestate):
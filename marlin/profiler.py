@@ -0,0 +1,59 @@
+import time
+from contextlib import contextmanager
+import pandas as pd
+
+class acqProfiler:
+    def __init__(self,enabled=True):
+        ### Records per-phase wall time; context keys (t, cycle, ...) are attached to every record ###
+        self.enabled = enabled
+        self.records = []
+        self.context = {}
+
+    @contextmanager
+    def phase(self,name,**keys):
+        if not self.enabled:
+            yield
+            return
+        ti = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name,time.perf_counter()-ti,**keys)
+
+    def add(self,name,duration,**keys):
+        if not self.enabled:
+            return
+        record = dict(self.context)
+        record.update(keys)
+        record["phase"] = name
+        record["duration"] = duration
+        self.records.append(record)
+
+    def set_context(self,**keys):
+        self.context.update(keys)
+
+    def clear_context(self,*names):
+        for name in names:
+            self.context.pop(name,None)
+
+    def frame(self,**filters):
+        records = pd.DataFrame.from_dict(self.records,orient="columns")
+        for key,value in filters.items():
+            if key in records:
+                records = records[records[key] == value]
+        return records
+
+    def summary(self,by=["phase"],**filters):
+        records = self.frame(**filters)
+        if len(records) == 0:
+            return records
+        return records.groupby(by,dropna=False)["duration"].agg(["count","sum","mean","max"])
+
+    def save(self,path,by=["phase"],**filters):
+        records = self.frame(**filters)
+        records.to_hdf(path,key="data",mode="w")
+        if len(records) > 0:
+            records.groupby(by,dropna=False)["duration"].agg(["count","sum","mean","max"]).to_hdf(path,key="summary",mode="a")
+
+    def reset(self):
+        self.records = []
@@ -0,0 +1,264 @@
+import json
+import time
+import copy
+from itertools import groupby
+from contextlib import ExitStack
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+step_types = {"reagent","pump","valve","wait","image","snapshot"}
+
+### Equivalent of FISH_scheduler.run with its default arguments ###
+default_protocol = {
+    "name": "FISH",
+    "num_cycles": 10,
+    "speeds": {"fast": 2000, "medium": 300, "slow": 100},
+    "fast_secs": 240,
+    "medium_secs": 300,
+    "setup": [
+        {"type": "snapshot", "name": "initial"},
+        {"type": "reagent", "reagent": "PFA(half-MeAc)"},
+        {"type": "snapshot", "name": "init_fixation"},
+        {"type": "reagent", "reagent": "EtOH(MeAc)"},
+        {"type": "pump", "speed": "slow"},
+        {"type": "wait", "mins": 45, "label": "EtOH(MeAc) incubation"},
+        {"type": "reagent", "reagent": "PFA(half-MeAc)"},
+        {"type": "snapshot", "name": "fixed"},
+    ],
+    "cycle": [
+        {"type": "reagent", "reagent": "Cleave", "skip_cycles": [1]},
+        {"type": "wait", "mins": 10, "label": "Cleave incubation", "skip_cycles": [1]},
+        {"type": "reagent", "reagent": "Probe {cycle}"},
+        {"type": "pump", "speed": "slow"},
+        {"type": "wait", "mins": 30, "label": "Probe {cycle} hybridization"},
+        {"type": "reagent", "reagent": "Image"},
+        {"type": "wait", "mins": 5, "label": "Image incubation"},
+        {"type": "pump", "speed": "slow"},
+        {"type": "image"},
+    ],
+    "teardown": [
+        {"type": "pump", "speed": 0},
+        {"type": "valve", "reagent": "SSC", "valve": 0},
+        {"type": "pump", "speed": "slow"},
+    ],
+}
+
+def load_protocol(path):
+    with open(path,"r") as infile:
+        if path.endswith(".yaml") or path.endswith(".yml"):
+            if yaml is None:
+                raise ImportError("PyYAML is required to load YAML protocols")
+            return yaml.safe_load(infile)
+        return json.load(infile)
+
+class protocolEngine:
+    def __init__(self,protocol,scheduler,optimize=True,command_secs=0.5,volume_per_speed_sec=1.,image_secs=0.):
+        ### Compiles a protocol into pump/valve/wait/image ops for one FISH_scheduler; volumes are in speed*secs unless calibrated ###
+        ### image_secs is the expected duration of one image step; left at 0 the runtime estimate covers fluidics only ###
+        if isinstance(protocol,str):
+            protocol = load_protocol(protocol)
+        self.protocol = copy.deepcopy(protocol)
+        self.scheduler = scheduler
+        self.optimize = optimize
+        self.command_secs = command_secs
+        self.volume_per_speed_sec = volume_per_speed_sec
+        self.image_secs = image_secs
+        self.num_cycles = self.protocol.get("num_cycles",1)
+        self.validate()
+        self.ops = self.compile(self.num_cycles)
+
+    def speed(self,value):
+        if isinstance(value,str):
+            return self.protocol.get("speeds",{})[value]
+        return value
+
+    def step_secs(self,step,key="secs"):
+        if key in step:
+            return float(step[key])
+        if "mins" in step:
+            return float(step["mins"])*60.
+        return None
+
+    def expand(self,cycle_num=None):
+        steps = list(self.protocol.get("setup",[])) if cycle_num is None else []
+        if cycle_num is not None:
+            for step in self.protocol.get("cycle",[]):
+                if cycle_num in step.get("skip_cycles",[]):
+                    continue
+                step = dict(step)
+                for key in ("reagent","label","name"):
+                    if key in step:
+                        step[key] = str(step[key]).format(cycle=cycle_num)
+                steps.append(step)
+        return steps
+
+    def all_steps(self,num_cycles):
+        steps = self.expand()
+        for c in range(1,num_cycles+1):
+            steps += [dict(step,cycle=c) for step in self.expand(c)]
+        steps += list(self.protocol.get("teardown",[]))
+        return steps
+
+    def validate(self):
+        handler = self.scheduler.handlerInstance
+        for step_num,step in enumerate(self.all_steps(self.num_cycles)):
+            step_type = step.get("type")
+            where = "Step " + str(step_num) + " (" + str(step_type) + "): "
+            if step_type not in step_types:
+                raise ValueError(where + "unknown step type")
+            if "reagent" in step and step["reagent"] not in handler.titanx_states:
+                raise ValueError(where + "reagent " + str(step["reagent"]) + " not in titanx_states")
+            if step_type == "pump":
+                try:
+                    speed = self.speed(step["speed"])
+                except KeyError:
+                    raise ValueError(where + "speed not defined")
+                if not 0 <= int(speed) <= 4095:
+                    raise ValueError(where + "speed out of range")
+            if step_type == "valve" and step.get("valve",0) not in handler.stage_valve_state_dict:
+                raise ValueError(where + "stage valve state not recognized")
+            if step_type == "wait":
+                secs = self.step_secs(step)
+                if secs is None or secs < 0:
+                    raise ValueError(where + "wait needs a non-negative secs or mins")
+            if step_type in ("image","snapshot") and self.scheduler.no_scope:
+                raise ValueError(where + "imaging requires a scopeInstance")
+
+    def compile(self,num_cycles):
+        ops = []
+        for step in self.all_steps(num_cycles):
+            cycle = step.get("cycle")
+            step_type = step["type"]
+            if step_type == "reagent":
+                reagent = step["reagent"]
+                fast_secs = self.step_secs(step,"fast_secs") or float(self.protocol.get("fast_secs",self.scheduler.secs_fast_speed))
+                medium_secs = self.step_secs(step,"medium_secs") or float(self.protocol.get("medium_secs",self.scheduler.secs_medium_speed))
+                fast_speed = self.speed(step.get("fast_speed","fast"))
+                medium_speed = self.speed(step.get("medium_speed","medium"))
+                ### The pump and valves stay routed to this sample for the whole load and any incubation after it, so fluidics ops hold the lock ###
+                ops += [{"op":"pump","speed":0,"locked":True,"cycle":cycle},
+                        {"op":"valve","reagent":reagent,"valve":1,"locked":True,"cycle":cycle},
+                        {"op":"pump","speed":fast_speed,"locked":True,"cycle":cycle},
+                        {"op":"wait","secs":fast_secs,"label":reagent + " (fast)","locked":True,"cycle":cycle},
+                        {"op":"pump","speed":medium_speed,"locked":True,"cycle":cycle},
+                        {"op":"valve","reagent":reagent,"valve":0,"locked":True,"cycle":cycle},
+                        {"op":"wait","secs":medium_secs,"label":reagent + " (medium)","locked":True,"cycle":cycle}]
+            elif step_type == "pump":
+                ops.append({"op":"pump","speed":self.speed(step["speed"]),"locked":True,"cycle":cycle})
+            elif step_type == "valve":
+                ops.append({"op":"valve","reagent":step["reagent"],"valve":step.get("valve",0),"locked":True,"cycle":cycle})
+            elif step_type == "wait":
+                ops.append({"op":"wait","secs":self.step_secs(step),"label":step.get("label","wait"),"locked":True,"cycle":cycle})
+            elif step_type == "image":
+                ops.append({"op":"image","locked":False,"cycle":cycle})
+            elif step_type == "snapshot":
+                ops.append({"op":"snapshot","name":step["name"],"locked":False,"cycle":cycle})
+        if self.optimize:
+            ops = self.optimize_ops(ops)
+        return ops
+
+    def optimize_ops(self,ops):
+        ### Drops transitions to the state already set, collapses back-to-back pump/valve writes and merges adjacent waits ###
+        optimized = []
+        reagent,valvestate,pumpstate = None,None,None
+        for op in ops:
+            prev = optimized[-1] if len(optimized) > 0 else None
+            same_block = prev is not None and prev["locked"] == op["locked"]
+            if op["op"] == "pump":
+                if op["speed"] == pumpstate:
+                    continue
+                if prev is not None and prev["op"] == "pump":
+                    optimized.pop()
+                pumpstate = op["speed"]
+            elif op["op"] == "valve":
+                if (op["reagent"],op["valve"]) == (reagent,valvestate):
+                    continue
+                if prev is not None and prev["op"] == "valve":
+                    optimized.pop()
+                reagent,valvestate = op["reagent"],op["valve"]
+            elif op["op"] == "wait":
+                if op["secs"] == 0.:
+                    continue
+                if same_block and prev["op"] == "wait":
+                    optimized[-1] = dict(prev,secs=prev["secs"] + op["secs"],label=prev["label"] + " + " + op["label"])
+                    continue
+            optimized.append(op)
+        return optimized
+
+    def estimate(self):
+        ### Mirrors run(): valve commands issued after the last pump command come out of the next wait, everything else adds to it ###
+        wait_secs = 0.
+        fluidics_secs = 0.
+        since_pump = 0.
+        num_commands = 0
+        num_images = 0
+        volumes = {}
+        reagent,pumpstate = None,0
+        for op in self.ops:
+            if op["op"] == "wait":
+                wait_secs += op["secs"]
+                fluidics_secs += max(op["secs"] - since_pump,0.)
+                since_pump = 0.
+                if reagent is not None:
+                    volumes[reagent] = volumes.get(reagent,0.) + pumpstate*op["secs"]*self.volume_per_speed_sec
+            elif op["op"] == "pump":
+                pumpstate = op["speed"]
+                num_commands += 1
+                fluidics_secs += self.command_secs
+                since_pump = 0.
+            elif op["op"] == "valve":
+                reagent = op["reagent"]
+                num_commands += 1
+                fluidics_secs += self.command_secs
+                since_pump += self.command_secs
+            elif op["op"] in ("image","snapshot"):
+                num_images += op["op"] == "image"
+                since_pump = 0.
+        image_secs = num_images*self.image_secs
+        return {"runtime_secs":fluidics_secs + image_secs,"fluidics_secs":fluidics_secs,"image_secs":image_secs,"wait_secs":wait_secs,\
+                "commands":num_commands,"images":num_images,"volumes":volumes}
+
+    def run(self,grid_coords=None,fov_ids=None):
+        scheduler = self.scheduler
+        handler = scheduler.handlerInstance
+        store = scheduler.open_store()
+        scheduler.store = store
+        ### Each wait is timed from the last pump command (or wait/image/snapshot), so a flow phase lasts its full time at its speed ###
+        ### while valve switches made after the pump was set come out of the wait rather than pushing the schedule back ###
+        t_last = time.monotonic()
+        try:
+            ### The fluidics lock is held across each run of consecutive locked ops and released for imaging ###
+            for locked,block in groupby(self.ops,key=lambda op: op["locked"]):
+                with ExitStack() as fluidics:
+                    if locked:
+                        fluidics.enter_context(scheduler.fluidics_lock)
+                    for op in block:
+                        if op["cycle"] is not None:
+                            scheduler.profiler.set_context(cycle=op["cycle"])
+
+                        if op["op"] == "pump":
+                            with scheduler.profiler.phase("fluidics",step="pump"):
+                                handler.set_pump_state(op["speed"])
+                            t_last = time.monotonic()
+                        elif op["op"] == "valve":
+                            with scheduler.profiler.phase("fluidics",step=op["reagent"]):
+                                handler.set_valve_state(op["reagent"],op["valve"])
+                        elif op["op"] == "wait":
+                            secs = max(op["secs"] - (time.monotonic() - t_last),0.)
+                            scheduler.wait(secs,step=op["label"])
+                            t_last = time.monotonic()
+                        elif op["op"] == "image":
+                            scheduler.image_cycle(store,grid_coords,op["cycle"],fov_ids=fov_ids)
+                            t_last = time.monotonic()
+                        elif op["op"] == "snapshot":
+                            scheduler.snapshot(store,grid_coords,op["name"])
+                            t_last = time.monotonic()
+        except BaseException:
+            scheduler.stop_pump()
+            raise
+        finally:
+            scheduler.profiler.clear_context("cycle")
+            scheduler.close_outputs()
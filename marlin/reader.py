@@ -0,0 +1,180 @@
+import os
+import re
+import json
+import numpy as np
+import h5py
+import pandas as pd
+
+try:
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
+
+frame_pattern = re.compile(r"^fov=(\d+)_config=(.+)_t=(\d+)\.hdf5$")
+metadata_pattern = re.compile(r"^metadata_(\d+)\.hdf5$")
+index_columns = ["t","fov","config","path","dataset","coord","offset","shape_y","shape_x","x","y","z","time"]
+
+def frame_location(dataset,coord):
+    ### Byte offset of an uncompressed frame-sized chunk (or contiguous dataset), or -1 when it has to go through h5py ###
+    frame_shape = dataset.shape[-2:]
+    frame_nbytes = int(np.prod(frame_shape))*dataset.dtype.itemsize
+    if dataset.id.get_create_plist().get_nfilters() > 0:
+        return -1
+    if dataset.chunks is None:
+        offset = dataset.id.get_offset()
+        if offset is None:
+            return -1
+        frame_num = int(np.ravel_multi_index(coord[:-2],dataset.shape[:-2])) if len(coord) > 2 else 0
+        return offset + frame_num*frame_nbytes
+    if dataset.chunks[-2:] != frame_shape or int(np.prod(dataset.chunks[:-2])) != 1:
+        return -1
+    chunk_info = dataset.id.get_chunk_info_by_coord(tuple(coord))
+    if chunk_info.byte_offset is None or chunk_info.size != frame_nbytes:
+        return -1
+    return chunk_info.byte_offset
+
+class lazyStack:
+    def __init__(self,reader,keys):
+        ### (t, channel) grid of index rows; frames are read only when indexed or converted with np.asarray ###
+        self.reader = reader
+        self.keys = keys
+        frame_shape = reader.frame_shape(keys[0][0]) if len(keys) > 0 and len(keys[0]) > 0 else (0,0)
+        self.shape = (len(keys),len(keys[0]) if len(keys) > 0 else 0) + tuple(frame_shape)
+        self.dtype = np.dtype('uint16')
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self,item):
+        if not isinstance(item,tuple):
+            item = (item,)
+        t_item,channel_item = (item + (slice(None),))[:2]
+        rest = item[2:]
+        t_idxs = range(self.shape[0])[t_item]
+        channel_idxs = range(self.shape[1])[channel_item]
+        if isinstance(t_idxs,int) and isinstance(channel_idxs,int):
+            return self.reader.read(self.keys[t_idxs][channel_idxs])[rest]
+        t_list = [t_idxs] if isinstance(t_idxs,int) else list(t_idxs)
+        channel_list = [channel_idxs] if isinstance(channel_idxs,int) else list(channel_idxs)
+        frames = np.stack([np.stack([self.reader.read(self.keys[t][c])[rest] for c in channel_list]) for t in t_list])
+        if isinstance(t_idxs,int):
+            return frames[0]
+        if isinstance(channel_idxs,int):
+            return frames[:,0]
+        return frames
+
+    def __array__(self,dtype=None):
+        frames = self[:,:]
+        return frames if dtype is None else frames.astype(dtype)
+
+class runReader:
+    def __init__(self,output_folder="./",index_name="index.hdf5",rebuild=False,memmap=True):
+        ### One pandas index over a run directory (per-frame files and/or run.hdf5), rebuilt only when output files are newer ###
+        self.output_folder = output_folder
+        self.index_path = os.path.join(output_folder,index_name)
+        self.memmap = memmap
+        self.h5pyfiles = {}
+        if rebuild or self.index_stale():
+            self.index = self.build_index()
+            self.index.to_hdf(self.index_path,key="index",mode="w")
+        else:
+            self.index = pd.read_hdf(self.index_path,key="index")
+        self.index["coord"] = self.index["coord"].apply(lambda coord: tuple(json.loads(coord)))
+        self.lookup = {(row.t,row.fov,row.config):row_num for row_num,row in enumerate(self.index.itertuples(index=False))}
+        self.channels = list(dict.fromkeys(self.index["config"]))
+        self.timepoints = sorted(int(t) for t in self.index["t"].unique())
+        self.fovs = sorted(int(fov) for fov in self.index["fov"].unique())
+
+    def output_files(self):
+        return [entry for entry in os.scandir(self.output_folder) if entry.is_file() and entry.name.endswith(".hdf5")\
+                and entry.path != self.index_path]
+
+    def index_stale(self):
+        if not os.path.exists(self.index_path):
+            return True
+        index_mtime = os.path.getmtime(self.index_path)
+        return any(entry.stat().st_mtime > index_mtime for entry in self.output_files())
+
+    def build_index(self):
+        rows = []
+        metadata = []
+        for entry in self.output_files():
+            frame_match = frame_pattern.match(entry.name)
+            metadata_match = metadata_pattern.match(entry.name)
+            if frame_match is not None:
+                fov,config,t = int(frame_match.group(1)),frame_match.group(2),int(frame_match.group(3))
+                with h5py.File(entry.path,"r") as h5pyfile:
+                    dataset = h5pyfile["data"]
+                    rows.append({"t":t,"fov":fov,"config":config,"path":entry.name,"dataset":"data","coord":json.dumps([0,0]),\
+                                 "offset":frame_location(dataset,(0,0)),"shape_y":dataset.shape[0],"shape_x":dataset.shape[1]})
+            elif metadata_match is not None:
+                t_metadata = pd.read_hdf(entry.path,key="data")
+                t_metadata["t_index"] = int(metadata_match.group(1))
+                metadata.append(t_metadata)
+            elif entry.name == "run.hdf5":
+                rows += self.index_run_file(entry)
+
+        index = pd.DataFrame.from_dict(rows,orient="columns")
+        if len(index) == 0:
+            return pd.DataFrame(columns=index_columns)
+        if len(metadata) > 0:
+            metadata = pd.concat(metadata).rename(columns={"t":"time","t_index":"t"})[["t","fov","config","x","y","z","time"]]
+            metadata = metadata.drop_duplicates(subset=["t","fov","config"],keep="last")
+            index = index.drop(columns=[column for column in ["x","y","z","time"] if column in index])
+            index = index.merge(metadata,on=["t","fov","config"],how="left")
+        for column in ["x","y","z","time"]:
+            if column not in index:
+                index[column] = np.nan
+        return index.sort_values(["t","fov","config"]).reset_index(drop=True)[index_columns]
+
+    def index_run_file(self,entry):
+        rows = []
+        with h5py.File(entry.path,"r") as h5pyfile:
+            if "data" not in h5pyfile:
+                return rows
+            dataset = h5pyfile["data"]
+            channels = json.loads(dataset.attrs["channels"])
+            for record in h5pyfile["metadata"][:]:
+                coord = (int(record["t"]),int(record["fov"]),int(record["channel"]),0,0)
+                rows.append({"t":coord[0],"fov":coord[1],"config":channels[coord[2]],"path":entry.name,"dataset":"data",\
+                             "coord":json.dumps(list(coord)),"offset":frame_location(dataset,coord),"shape_y":dataset.shape[3],\
+                             "shape_x":dataset.shape[4],"x":record["x"],"y":record["y"],"z":record["z"],"time":record["time"]})
+        return rows
+
+    def channel_name(self,channel):
+        return self.channels[channel] if isinstance(channel,(int,np.integer)) else channel
+
+    def row(self,t,fov,channel):
+        return self.index.iloc[self.lookup[(t,fov,self.channel_name(channel))]]
+
+    def frame_shape(self,row):
+        return (int(row["shape_y"]),int(row["shape_x"]))
+
+    def read(self,row):
+        path = os.path.join(self.output_folder,row["path"])
+        if self.memmap and row["offset"] >= 0:
+            return np.memmap(path,dtype='uint16',mode='r',offset=int(row["offset"]),shape=self.frame_shape(row))
+        if path not in self.h5pyfiles:
+            self.h5pyfiles[path] = h5py.File(path,"r")
+        coord = row["coord"]
+        return self.h5pyfiles[path][row["dataset"]][tuple(coord[:-2])]
+
+    def __getitem__(self,key):
+        t,fov,channel = key
+        return self.read(self.row(t,fov,channel))
+
+    def fov_stack(self,fov,channels=None,timepoints=None):
+        channels = self.channels if channels is None else [self.channel_name(channel) for channel in channels]
+        timepoints = self.timepoints if timepoints is None else timepoints
+        return lazyStack(self,[[self.row(t,fov,channel) for channel in channels] for t in timepoints])
+
+    def metadata(self,**filters):
+        metadata = self.index
+        for key,value in filters.items():
+            metadata = metadata[metadata[key] == value]
+        return metadata
+
+    def close(self):
+        for h5pyfile in self.h5pyfiles.values():
+            h5pyfile.close()
+        self.h5pyfiles = {}
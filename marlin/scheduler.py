@@ -1,15 +1,42 @@
 import os
+import time
+import threading
 from time import sleep
-import h5py
+from functools import partial
+from contextlib import nullcontext
+import pandas as pd
+from .storage import open_store,runJournal
+from .profiler import acqProfiler
+from .protocol import protocolEngine
 
-def wait_for(num_secs):
-    num_secs = int(num_secs)
-    for t in range(num_secs):
-        sleep(1.)
+def wait_for(num_secs,cancel_event=None,monitors=[],progress=None,progress_interval=60.):
+    ### Sleeps until a time.monotonic deadline, waking only for monitor callbacks; returns False if cancel_event was set ###
+    t_start = time.monotonic()
+    deadline = t_start + num_secs
+    if progress is not None:
+        monitors = list(monitors) + [(progress_interval,progress)]
+    next_calls = [t_start + interval for interval,fn in monitors]
+
+    while True:
+        now = time.monotonic()
+        for monitor_num,(interval,fn) in enumerate(monitors):
+            if now >= next_calls[monitor_num] and now < deadline:
+                fn(now - t_start,num_secs)
+                next_calls[monitor_num] += interval
+        now = time.monotonic()
+        if now >= deadline:
+            return True
+        timeout = min([deadline] + next_calls) - now
+        if cancel_event is None:
+            sleep(max(timeout,0.))
+        elif cancel_event.wait(max(timeout,0.)):
+            return False
 
 class FISH_scheduler:
     def __init__(self,handlerInstance,scopeInstance=None,skip_fixation=False,include_wash_cycle=False,fast_speed=2000,medium_speed=300,slow_speed=100,\
-                 mins_fast_speed=4.,mins_medium_speed=5.,channels=["BF","GFP","Cy5","Cy7"],output_folder="./"):
+                 mins_fast_speed=4.,mins_medium_speed=5.,channels=["BF","GFP","Cy5","Cy7"],output_folder="./",storage="files",focus_map=None,\
+                 profiler=None,wait_fn=None,fluidics_lock=None,scope_lock=None,progress=None,progress_interval=60.,compression=None,\
+                 streaming=None):
         self.handlerInstance = handlerInstance
         self.scopeInstance = scopeInstance
         self.skip_fixation = skip_fixation
@@ -28,20 +55,140 @@ class FISH_scheduler:
         
         self.channels = channels                                          
         self.output_folder = output_folder
+        self.storage = storage
+        self.compression = compression
+        ### None streams frames to the store as they are acquired whenever a journal is open, so each frame is journaled once written ###
+        self.streaming = streaming
+        self.focus_map = focus_map
+        self.profiler = acqProfiler(enabled=False) if profiler is None else profiler
+        self.wait_fn = wait_for if wait_fn is None else wait_fn
+        ### Shared pump/valve and microscope are guarded by these when several samples run concurrently ###
+        self.fluidics_lock = nullcontext() if fluidics_lock is None else fluidics_lock
+        self.scope_lock = nullcontext() if scope_lock is None else scope_lock
+        self.journal = None
+        self.step_prefix = ""
+        ### Waits can be cancelled from another thread; monitors are (interval_secs, fn(elapsed, total), step substring or None) ###
+        self.cancel_event = threading.Event()
+        self.monitors = []
+        self.progress = progress
+        self.progress_interval = progress_interval
+        self.wait_log = []
+        self.store = None
+        self.step_num = 0
+
+    def wait(self,num_secs,step="wait"):
+        ti = time.monotonic()
+        with self.profiler.phase("wait",step=step):
+            if self.wait_fn is wait_for:
+                monitors = [(interval,fn) for interval,fn,match in self.monitors if match is None or match in step]
+                progress = None if self.progress is None else partial(self.progress,step)
+                completed = wait_for(num_secs,cancel_event=self.cancel_event,monitors=monitors,progress=progress,\
+                                     progress_interval=self.progress_interval)
+            else:
+                self.wait_fn(num_secs)
+                completed = not self.cancel_event.is_set()
+        self.wait_log.append({"step":step,"planned":num_secs,"actual":time.monotonic()-ti,"cancelled":not completed})
+        if not completed:
+            raise InterruptedError("Run cancelled during " + step)
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def wait_timing(self):
+        timing = pd.DataFrame.from_dict(self.wait_log,orient="columns")
+        if len(timing) > 0:
+            timing["drift"] = timing["actual"] - timing["planned"]
+        return timing
+
+    def add_monitor(self,interval_secs,fn,match=None):
+        self.monitors.append((interval_secs,fn,match))
+
+    def add_timelapse(self,grid_coords,interval_secs=5*60,match="hybridization",fov_idx=0):
+        ### Snaps one FOV every interval_secs during matching waits; frames go to the run store as snapshots ###
+        ### The scope lock is only waited on for the rest of the wait, so another sample's imaging can't push an incubation past its deadline ###
+        def snap_timelapse(elapsed,total):
+            if self.no_scope or self.store is None:
+                return
+            acquire = getattr(self.scope_lock,"acquire",None)
+            if acquire is not None and not acquire(timeout=max(total - elapsed,0.)):
+                print("Scope busy, skipped timelapse frame at " + str(int(elapsed)) + " s.")
+                return
+            try:
+                x_coord,y_coord = grid_coords[fov_idx]
+                img = self.snap_at(x_coord,y_coord)
+            finally:
+                if acquire is not None:
+                    self.scope_lock.release()
+            self.store.write_snapshot(self.step_prefix + " timelapse t=" + str(int(elapsed)),img)
+        self.add_monitor(interval_secs,snap_timelapse,match=match)
+
+    def begin_steps(self,prefix):
+        self.step_prefix = prefix
+        self.step_num = 0
+
+    def step_key(self,name):
+        ### Keys are numbered within a phase so repeated reagents (e.g. PFA during fixation) stay distinct ###
+        self.step_num += 1
+        return self.step_prefix + "/" + str(self.step_num) + ":" + name
+
+    def step_done(self,key):
+        return self.journal is not None and self.journal.step_done(key)
+
+    def record_step(self,key):
+        if self.journal is not None:
+            handler = self.handlerInstance
+            self.journal.record_step(key,valvestate=handler.valvestate,pumpstate=handler.pumpstate,titanxstates=list(handler.titanxstates))
+
+    def incubate(self,num_secs,step):
+        ### After a crash the sample kept incubating, so a resumed incubation only waits out the remainder ###
+        key = self.step_key(step)
+        if self.step_done(key):
+            return
+        if self.journal is not None:
+            t_started = self.journal.wait_started(key)
+            if t_started is None:
+                self.journal.record_wait_start(key)
+            else:
+                num_secs = max(num_secs - (time.time() - t_started),0.)
+        self.wait(num_secs,step=step)
+        self.record_step(key)
+
+    def restore_fluidics(self):
+        ### Re-sends the last journaled pump/valve state with a full handshake rather than trusting the handler's cache ###
+        last_step = self.journal.last_step()
+        if last_step is None:
+            return
+        with self.fluidics_lock:
+            if hasattr(self.handlerInstance,"invalidate_state"):
+                self.handlerInstance.invalidate_state()
+            self.handlerInstance.sendstate(last_step["valvestate"],last_step["pumpstate"],last_step["titanxstates"])
+        print("Resuming after " + last_step["key"])
             
+    def set_pump_state(self,pumpstate):
+        with self.fluidics_lock:
+            self.handlerInstance.set_pump_state(pumpstate)
+
     def load_reagent(self,reagent_name):
-        print(reagent_name)
-        
-        self.handlerInstance.set_pump_state(0)
-        self.handlerInstance.set_valve_state(reagent_name,1)
-        self.handlerInstance.set_pump_state(self.fast_speed)
-        
-        wait_for(self.secs_fast_speed)
-    
-        self.handlerInstance.set_pump_state(self.medium_speed)
-        self.handlerInstance.set_valve_state(reagent_name,0)
+        key = self.step_key("load " + reagent_name)
+        if self.step_done(key):
+            return True
+        ### The pump and valves stay routed to this sample for the whole load, so the lock spans both flow phases ###
+        with self.fluidics_lock:
+            print(reagent_name)
+
+            with self.profiler.phase("fluidics",step=reagent_name):
+                self.handlerInstance.set_pump_state(0)
+                self.handlerInstance.set_valve_state(reagent_name,1)
+                self.handlerInstance.set_pump_state(self.fast_speed)
+
+            self.wait(self.secs_fast_speed,step=reagent_name + " (fast)")
 
-        wait_for(self.secs_medium_speed)
+            with self.profiler.phase("fluidics",step=reagent_name):
+                self.handlerInstance.set_pump_state(self.medium_speed)
+                self.handlerInstance.set_valve_state(reagent_name,0)
+
+            self.wait(self.secs_medium_speed,step=reagent_name + " (medium)")
+            self.record_step(key)
         return True
         
     def init_fixation(self):
@@ -49,74 +196,239 @@ class FISH_scheduler:
         print("Initialized.")
         
     def continue_fixation(self):
-        self.load_reagent("EtOH(MeAc)")
-        self.handlerInstance.set_pump_state(self.slow_speed)
-        wait_for(45*60)
-        self.load_reagent("PFA(half-MeAc)")
+        ### An incubation needs the pump and valves left as the load set them, so the fluidics lock is held across it ###
+        with self.fluidics_lock:
+            self.load_reagent("EtOH(MeAc)")
+            self.set_pump_state(self.slow_speed)
+            self.incubate(45*60,"EtOH(MeAc) incubation")
+            self.load_reagent("PFA(half-MeAc)")
         print("Fixed.")
         
     def perform_cycle(self,cycle_num,no_cleave=False):
         reagent_name = "Probe " + str(cycle_num)
         
-        if not no_cleave:
-            self.load_reagent("Cleave")
-            wait_for(10*60)
-
-        if self.include_wash_cycle:
-            self.load_reagent("SSC")
-            self.handlerInstance.set_pump_state(self.slow_speed)
-            self.wait_for(3*60)
+        ### Held from the first load to the last incubation; a sample sharing this handler can only load while this one is imaging ###
+        with self.fluidics_lock:
+            if not no_cleave:
+                self.load_reagent("Cleave")
+                self.incubate(10*60,"Cleave incubation")
+
+            if self.include_wash_cycle:
+                self.load_reagent("SSC")
+                self.set_pump_state(self.slow_speed)
+                self.incubate(3*60,"SSC incubation")
             
-        self.load_reagent(reagent_name)
-        self.handlerInstance.set_pump_state(self.slow_speed)
-        wait_for(30*60)
-        self.load_reagent("Image")
-        wait_for(5*60)
-        self.handlerInstance.set_pump_state(self.slow_speed)
+            self.load_reagent(reagent_name)
+            self.set_pump_state(self.slow_speed)
+            self.incubate(30*60,reagent_name + " hybridization")
+            self.load_reagent("Image")
+            self.incubate(5*60,"Image incubation")
+            self.set_pump_state(self.slow_speed)
         
-    def run(self,grid_coords=None,num_cycles=10):
-        if not os.path.exists(self.output_folder):
-            os.makedir(self.output_folder)
+    def open_store(self):
+        os.makedirs(self.output_folder,exist_ok=True)
+        return open_store(self.storage,self.output_folder,channels=self.channels,compression=self.compression)
+
+    def snap_at(self,x_coord,y_coord):
+        ### snapImage does not wait for the XY stage, so the move has to finish first ###
+        self.scopeInstance.move_to(x_coord,y_coord)
+        self.scopeInstance.waiter.wait(self.scopeInstance.xystage_name,label="move")
+        return self.scopeInstance.snap_image()
+
+    def snapshot(self,store,grid_coords,name):
+        key = self.step_key("snapshot " + name)
+        if self.step_done(key):
+            return
+        with self.scope_lock:
+            first_x,first_y = grid_coords[0]
+            img = self.snap_at(first_x,first_y)
+        store.write_snapshot(name,img)
+        self.record_step(key)
+
+    def image_cycle(self,store,grid_coords,cycle_num,fov_ids=None):
+        key = self.step_key("image")
+        if self.step_done(key):
+            return
+        print("Imageing...")
+        streaming = self.journal is not None if self.streaming is None else self.streaming
+
+        with self.scope_lock,self.profiler.phase("image"):
+            self.scopeInstance.multipoint_aq(grid_coords,self.channels,cycle_num,output_folder=self.output_folder,store=store,fov_ids=fov_ids,\
+                                             focus_map=self.focus_map,profiler=self.profiler if self.profiler.enabled else None,\
+                                             journal=self.journal,streaming=streaming)
+        if self.focus_map is not None:
+            self.focus_map.save(self.output_folder + "focus_map.hdf5")
+        if self.profiler.enabled:
+            self.profiler.save(self.output_folder + "cycle_timing.hdf5",by=["cycle","phase"])
+        self.record_step(key)
+
+    def print_counters(self):
+        if hasattr(self.handlerInstance,"counters"):
+            counters = self.handlerInstance.counters()
+            print("Fluidics transitions sent: " + str(counters["sent"]) + ", skipped: " + str(counters["skipped"]) + ", verified by readback: " + str(counters["verified"]))
+
+    def stop_pump(self):
+        ### Best effort after a cancel or error: the original exception is what the caller needs to see ###
+        try:
+            with self.fluidics_lock:
+                self.handlerInstance.set_pump_state(0)
+        except Exception as e:
+            print("Could not stop the pump: " + str(e))
+
+    def close_outputs(self):
+        if self.store is not None:
+            self.store.close()
+            self.store = None
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+
+    def run(self,grid_coords=None,num_cycles=10,fov_ids=None,resume=False):
+        store = self.open_store()
+        self.store = store
+        self.cancel_event.clear()
+        try:
+            ### journal.jsonl in output_folder records each completed step and written frame; resume=True picks up after the last one ###
+            self.journal = runJournal(self.output_folder + "journal.jsonl",resume=resume)
+            if resume:
+                self.restore_fluidics()
         
-        if not self.skip_fixation:
+            if not self.skip_fixation:
+                self.begin_steps("fixation")
         
-            if not self.no_scope:
-                first_x,first_y = grid_coords[0]
-                self.scopeInstance.mmc.setXYPosition(first_x,first_y)
+                if not self.no_scope:
+                    self.snapshot(store,grid_coords,"initial")
 
-                img = self.scopeInstance.snap_image()
+                self.init_fixation()
 
-                with h5py.File(self.output_folder + "initial.hdf5","w") as h5pyfile:
-                    hdf5_dataset = h5pyfile.create_dataset("data", data=img, chunks=(128,128), dtype='uint16')
+                if not self.no_scope:
+                    self.snapshot(store,grid_coords,"init_fixation")
 
-            self.init_fixation()
+                self.continue_fixation()
 
-            if not self.no_scope:
+                if not self.no_scope:
+                    self.snapshot(store,grid_coords,"fixed")
 
-                img = self.scopeInstance.snap_image()
+            for c in range(1,num_cycles+1):
+                self.profiler.set_context(cycle=c)
+                self.begin_steps("cycle " + str(c))
+                if c == 1:
+                    self.perform_cycle(c,no_cleave=True)
+                else:
+                    self.perform_cycle(c)
+            
+                if not self.no_scope:
+                    self.image_cycle(store,grid_coords,c,fov_ids=fov_ids)
+                elif self.profiler.enabled:
+                    self.profiler.save(self.output_folder + "cycle_timing.hdf5",by=["cycle","phase"])
+                
+            with self.fluidics_lock:
+                self.handlerInstance.set_pump_state(0)
+                self.handlerInstance.set_valve_state("SSC",0)
+                self.handlerInstance.set_pump_state(self.slow_speed)
+        except BaseException:
+            ### Cancelled or failed: leave the pump off rather than flowing whatever was last loaded ###
+            self.stop_pump()
+            raise
+        finally:
+            self.profiler.clear_context("cycle")
+            self.close_outputs()
+        self.print_counters()
 
-                with h5py.File(self.output_folder + "init_fixation.hdf5","w") as h5pyfile:
-                    hdf5_dataset = h5pyfile.create_dataset("data", data=img, chunks=(128,128), dtype='uint16')
+    def run_protocol(self,protocol,grid_coords=None,fov_ids=None,optimize=True,image_secs=0.):
+        ### protocol is a dict or a path to a JSON/YAML step file, see marlin.protocol ###
+        engine = protocolEngine(protocol,self,optimize=optimize,image_secs=image_secs)
+        estimate = engine.estimate()
+        if image_secs > 0.:
+            print("Estimated runtime: " + str(round(estimate["runtime_secs"]/60.,1)) + " min over " + str(estimate["commands"]) + " fluidics commands")
+        else:
+            print("Estimated fluidics runtime (excluding imaging): " + str(round(estimate["fluidics_secs"]/60.,1)) + " min over " + \
+                  str(estimate["commands"]) + " fluidics commands")
+        engine.run(grid_coords=grid_coords,fov_ids=fov_ids)
+        self.print_counters()
+        return estimate
 
-            self.continue_fixation()
+class timedLock:
+    def __init__(self):
+        ### Reentrant lock that records how long it was held and how long callers queued for it; nested holds count once ###
+        self.lock = threading.RLock()
+        self.depth = 0
+        self.busy_secs = 0.
+        self.wait_secs = 0.
+        self.acquisitions = 0
+        self.t_acquired = None
 
-            if not self.no_scope:
-                img = self.scopeInstance.snap_image()
+    def acquire(self,blocking=True,timeout=-1):
+        ti = time.perf_counter()
+        if not self.lock.acquire(blocking,timeout):
+            self.wait_secs += time.perf_counter() - ti
+            return False
+        self.depth += 1
+        if self.depth == 1:
+            self.t_acquired = time.perf_counter()
+            self.wait_secs += self.t_acquired - ti
+            self.acquisitions += 1
+        return True
 
-                with h5py.File(self.output_folder + "fixed.hdf5","w") as h5pyfile:
-                    hdf5_dataset = h5pyfile.create_dataset("data", data=img, chunks=(128,128), dtype='uint16')
+    def release(self):
+        self.depth -= 1
+        if self.depth == 0:
+            self.busy_secs += time.perf_counter() - self.t_acquired
+        self.lock.release()
 
-        for c in range(1,num_cycles+1):
-            if c == 1:
-                self.perform_cycle(c,no_cleave=True)
-            else:
-                self.perform_cycle(c)
-            
-            if not self.no_scope:
-                print("Imageing...")
+    def __enter__(self):
+        self.acquire()
+        return self
 
-                self.scopeInstance.multipoint_aq(grid_coords,self.channels,c,output_folder=self.output_folder)
-                
-        self.handlerInstance.set_pump_state(0)
-        self.handlerInstance.set_valve_state("SSC",0)
-        self.handlerInstance.set_pump_state(self.slow_speed)
\ No newline at end of file
+    def __exit__(self,exc_type,exc_value,traceback):
+        self.release()
+
+class concurrentScheduler:
+    def __init__(self,schedulers):
+        ### Runs one FISH_scheduler per sample on its own thread, with one fluidics lock per handler and one scope lock per scope ###
+        ### Samples on separate handlers load in parallel; samples sharing a handler take turns, each holding it through its incubations ###
+        self.schedulers = schedulers
+        output_folders = [os.path.abspath(scheduler.output_folder) for scheduler in self.schedulers]
+        if len(set(output_folders)) < len(output_folders):
+            raise ValueError("Each sample needs its own output_folder; journal.jsonl and run outputs would be overwritten")
+        self.fluidics_locks = {}
+        self.scope_locks = {}
+        for scheduler in self.schedulers:
+            scheduler.fluidics_lock = self.fluidics_locks.setdefault(id(scheduler.handlerInstance),timedLock())
+            if not scheduler.no_scope:
+                scheduler.scope_lock = self.scope_locks.setdefault(id(scheduler.scopeInstance),timedLock())
+        self.elapsed = 0.
+
+    def run(self,grid_coords_list,num_cycles=10,fov_ids_list=None):
+        if fov_ids_list is None:
+            fov_ids_list = [None for scheduler in self.schedulers]
+        errors = []
+
+        def run_sample(scheduler,grid_coords,fov_ids):
+            try:
+                scheduler.run(grid_coords=grid_coords,num_cycles=num_cycles,fov_ids=fov_ids)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=run_sample,args=args) for args in zip(self.schedulers,grid_coords_list,fov_ids_list)]
+        ti = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.elapsed = time.perf_counter() - ti
+        if len(errors) > 0:
+            raise errors[0]
+        return self.utilization()
+
+    def utilization(self):
+        ### Utilization is averaged over handlers (and scopes); wait_secs are summed ###
+        if self.elapsed == 0.:
+            return {}
+        fluidics_locks = list(self.fluidics_locks.values())
+        scope_locks = list(self.scope_locks.values())
+        return {"elapsed_secs":self.elapsed,\
+                "fluidics_utilization":sum(lock.busy_secs for lock in fluidics_locks)/(self.elapsed*max(len(fluidics_locks),1)),\
+                "scope_utilization":sum(lock.busy_secs for lock in scope_locks)/(self.elapsed*max(len(scope_locks),1)),\
+                "fluidics_wait_secs":sum(lock.wait_secs for lock in fluidics_locks),\
+                "scope_wait_secs":sum(lock.wait_secs for lock in scope_locks)}
@@ -2,14 +2,18 @@ import numpy as np
 import pandas as pd
 import matplotlib
 import pymmcore
-from IPython.display import clear_output
+from IPython.display import clear_output,display
 from time import sleep
 import matplotlib.pyplot as plt
 import time
 import xml.etree.ElementTree as ET
-import h5py
+import itertools
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from .storage import fileStore,streamWriter,framePool
+from .profiler import acqProfiler
 
-def load_multipoints(multipoints_path,filetype="auto"):
+def load_multipoints(multipoints_path,filetype="auto",return_focus=False):
     if filetype=="auto":
         file_suffix = multipoints_path[-3:]
     else:
@@ -17,9 +21,13 @@ def load_multipoints(multipoints_path,filetype="auto"):
     if file_suffix=="csv":
         positions = load_csv_multipoints(multipoints_path)
     elif file_suffix=="xml":
-        positions = load_xml_multipoints(multipoints_path)
+        positions = load_xml_multipoints(multipoints_path,return_focus=return_focus)
+        if return_focus:
+            return positions
     else:
         raise ValueError('Filetype not recognized')
+    if return_focus:
+        return positions,[None for position in positions]
     return positions
 
 def load_csv_multipoints(multipoints_path,scaling=1000.):
@@ -40,14 +48,18 @@ def parse_xml_position(e):
         pfs_offset=float(e.find("dPFSOffset").attrib["value"]),
     )
 
-def load_xml_multipoints(filename):
+def load_xml_multipoints(filename,return_focus=False):
     positions = []
+    focus = []
     with open(filename, encoding="utf-16") as input:
         input_xml = ET.parse(input, parser=ET.XMLParser(encoding="utf-16"))
     for e in input_xml.findall("./no_name/*"):
         if e.tag not in ("bIncludeZ", "bPFSEnabled"):
             p = parse_xml_position(e)
             positions.append((p["x"], p["y"]))
+            focus.append((p["z"], p["pfs_offset"]))
+    if return_focus:
+        return positions,focus
     return positions
 
 def check_grid_corners(scopeInstance,xy_grid,shift_tol=100,wait_time=0):
@@ -68,9 +80,261 @@ def check_grid_corners(scopeInstance,xy_grid,shift_tol=100,wait_time=0):
         scopeInstance.mmc.setXYPosition(selected_point[0],selected_point[1])
         sleep(wait_time)
 
+def path_distances(coords,point,metric="euclidean"):
+    disp = np.abs(coords-point)
+    if metric == "euclidean":
+        return np.sqrt(np.sum(disp**2,axis=-1))
+    elif metric == "chebyshev":
+        return np.max(disp,axis=-1)
+    else:
+        raise ValueError("Metric not recognized")
+
+def path_length(positions,metric="euclidean"):
+    coords = np.array(positions,dtype=float)[:,:2]
+    return float(np.sum(path_distances(coords[1:],coords[:-1],metric=metric)))
+
+def nearest_neighbour_order(coords,start=0,metric="euclidean"):
+    visited = np.zeros(len(coords),dtype=bool)
+    order = [start]
+    visited[start] = True
+    for _ in range(len(coords)-1):
+        dists = path_distances(coords,coords[order[-1]],metric=metric)
+        dists[visited] = np.inf
+        next_idx = int(np.argmin(dists))
+        order.append(next_idx)
+        visited[next_idx] = True
+    return np.array(order)
+
+def two_opt_order(coords,order,metric="euclidean",max_iter=100,tol=1e-6):
+    ### Open-path 2-opt: for each edge (a,b), score reversing path[i+1:j+1] against every later edge at once ###
+    order = np.array(order)
+    num_points = len(order)
+    for _ in range(max_iter):
+        improved = False
+        for i in range(num_points-2):
+            path = coords[order]
+            a,b = path[i],path[i+1]
+            c = path[i+2:]
+            d = path[i+3:]
+            d_ab = path_distances(b,a,metric=metric)
+            d_cd = np.append(path_distances(d,c[:-1],metric=metric),0.)
+            d_ac = path_distances(c,a,metric=metric)
+            d_bd = np.append(path_distances(d,b,metric=metric),0.)
+            gain = d_ab + d_cd - d_ac - d_bd
+            best = int(np.argmax(gain))
+            if gain[best] > tol:
+                j = i+2+best
+                order[i+1:j+1] = order[i+1:j+1][::-1]
+                improved = True
+        if not improved:
+            break
+    return order
+
+def optimize_path(positions,start=0,metric="euclidean",max_iter=100,verbose=True):
+    coords = np.array(positions,dtype=float)[:,:2]
+    if len(coords) < 3:
+        order = np.arange(len(coords))
+    else:
+        order = nearest_neighbour_order(coords,start=start,metric=metric)
+        order = two_opt_order(coords,order,metric=metric,max_iter=max_iter)
+    ordered_positions = [positions[idx] for idx in order]
+    fov_ids = [int(idx) for idx in order]
+
+    if verbose:
+        dist_before = path_length(positions,metric=metric)
+        dist_after = path_length(ordered_positions,metric=metric)
+        print("Estimated stage travel: " + str(round(dist_before,1)) + " um -> " + str(round(dist_after,1)) + " um")
+    return ordered_positions,fov_ids
+
+class focusMap:
+    def __init__(self,positions=None,focus=None,fov_ids=None):
+        ### Per-FOV Z and PFS offset; unmeasured FOVs are predicted from a plane fit over the measured ones ###
+        self.points = {}
+        if positions is not None:
+            for fov_idx,(position,fov_focus) in enumerate(zip(positions,focus)):
+                if fov_focus is not None:
+                    fov_num = fov_idx if fov_ids is None else fov_ids[fov_idx]
+                    self.record(fov_num,position[0],position[1],*fov_focus)
+
+    def record(self,fov_num,x,y,z,pfs_offset=None):
+        self.points[fov_num] = {"x":x,"y":y,"z":z,"pfs_offset":pfs_offset}
+
+    def predict(self,fov_num,x,y):
+        if fov_num in self.points:
+            point = self.points[fov_num]
+            return point["z"],point["pfs_offset"]
+        if len(self.points) == 0:
+            return None
+        points = pd.DataFrame.from_dict(self.points,orient="index")
+        if len(points) < 3:
+            nearest = ((points["x"]-x)**2 + (points["y"]-y)**2).idxmin()
+            return points.loc[nearest,"z"],points.loc[nearest,"pfs_offset"]
+        design = np.stack([points["x"].values,points["y"].values,np.ones(len(points))],axis=1)
+        query = np.array([x,y,1.])
+        z_coef = np.linalg.lstsq(design,points["z"].values.astype(float),rcond=None)[0]
+        z = float(query @ z_coef)
+        if points["pfs_offset"].isnull().any():
+            return z,None
+        pfs_coef = np.linalg.lstsq(design,points["pfs_offset"].values.astype(float),rcond=None)[0]
+        return z,float(query @ pfs_coef)
+
+    def save(self,path):
+        points = pd.DataFrame.from_dict(self.points,orient="index")
+        points.index.name = "fov"
+        points.to_hdf(path,key="data",mode="w")
+
+    @classmethod
+    def load(cls,path):
+        focus_map = cls()
+        points = pd.read_hdf(path,key="data")
+        for fov_num,row in points.iterrows():
+            focus_map.record(fov_num,row["x"],row["y"],row["z"],row["pfs_offset"])
+        return focus_map
+
+class deviceWaiter:
+    def __init__(self,mmc,timeout=30.,min_interval=0.001,max_interval=0.05,blocking=False):
+        ### Polls start fast and back off exponentially; each device's first poll interval adapts to its typical wait ###
+        self.mmc = mmc
+        self.timeout = timeout
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.blocking = blocking
+        self.intervals = {}
+        self.waits = []
+
+    def busy(self,device=None):
+        if device is None:
+            return self.mmc.systemBusy()
+        return self.mmc.deviceBusy(device)
+
+    def block(self,device,timeout):
+        previous_timeout = self.mmc.getTimeoutMs()
+        self.mmc.setTimeoutMs(int(timeout*1000))
+        try:
+            if device is None:
+                self.mmc.waitForSystem()
+            else:
+                self.mmc.waitForDevice(device)
+        finally:
+            self.mmc.setTimeoutMs(previous_timeout)
+
+    def wait(self,device=None,timeout=None,label=None,record=True):
+        if timeout is None:
+            timeout = self.timeout
+        key = "system" if device is None else device
+        ti = time.perf_counter()
+
+        if self.blocking:
+            self.block(device,timeout)
+        else:
+            interval = self.intervals.get(key,self.min_interval)
+            while self.busy(device):
+                if time.perf_counter()-ti > timeout:
+                    raise TimeoutError(key + " still busy after " + str(timeout) + " s")
+                time.sleep(interval)
+                interval = min(interval*2,self.max_interval)
+
+        duration = time.perf_counter()-ti
+        self.intervals[key] = min(max(duration/8.,self.min_interval),self.max_interval)
+        if record:
+            self.waits.append({"device":key,"label":label,"duration":duration})
+        return duration
+
+    def summary(self):
+        waits = pd.DataFrame.from_dict(self.waits,orient="columns")
+        if len(waits) == 0:
+            return waits
+        return waits.groupby(["device","label"],dropna=False)["duration"].agg(["count","sum","mean","max"])
+
+    def reset(self):
+        self.waits = []
+
+def read_config_settings(mmc,group_name,config):
+    config_data = mmc.getConfigData(group_name,config)
+    settings = {}
+    for setting_num in range(config_data.size()):
+        setting = config_data.getSetting(setting_num)
+        settings[(setting.getDeviceLabel(),setting.getPropertyName())] = setting.getPropertyValue()
+    return settings
+
+def downsample(img,display_shape):
+    ### Strided view, so no copy is made before rendering ###
+    step = int(np.ceil(max(img.shape[0]/display_shape[0],img.shape[1]/display_shape[1],1.)))
+    return img[::step,::step]
+
+def histogram_percentiles(img,percentiles,stride=1):
+    ### One bincount over the (optionally strided) integer pixels; every percentile is read off the cumulative histogram ###
+    sample = img[::stride,::stride]
+    if not np.issubdtype(sample.dtype,np.integer):
+        return [np.percentile(sample,percentile) for percentile in percentiles]
+    cumulative = np.cumsum(np.bincount(sample.ravel()))
+    num_pixels = cumulative[-1]
+    return [int(np.searchsorted(cumulative,(percentile/100.)*(num_pixels-1),side="right")) for percentile in percentiles]
+
+class contrastTracker:
+    def __init__(self,low_percentile=0.5,high_percentile=99.5,stride=4,smoothing=0.8):
+        ### Exponential running average of the display limits so live contrast doesn't flicker frame to frame ###
+        self.percentiles = [low_percentile,high_percentile]
+        self.stride = stride
+        self.smoothing = smoothing
+        self.low = None
+        self.high = None
+
+    def update(self,img):
+        low,high = histogram_percentiles(img,self.percentiles,stride=self.stride)
+        if self.low is None:
+            self.low,self.high = float(low),float(high)
+        else:
+            self.low = self.smoothing*self.low + (1.-self.smoothing)*low
+            self.high = self.smoothing*self.high + (1.-self.smoothing)*high
+        return self.low,max(self.high,self.low+1.)
+
+    def reset(self):
+        self.low = None
+        self.high = None
+
+class configCache:
+    def __init__(self,mmc):
+        ### Tracks the last value written to each device property so preset switches only write the deltas ###
+        self.mmc = mmc
+        self.settings = {}
+        self.state = {}
+        self.issued = 0
+        self.skipped = 0
+
+    def get_settings(self,group_name,config):
+        if (group_name,config) not in self.settings:
+            self.settings[(group_name,config)] = read_config_settings(self.mmc,group_name,config)
+        return self.settings[(group_name,config)]
+
+    def apply(self,group_name,config):
+        for (device,prop),value in self.get_settings(group_name,config).items():
+            if self.state.get((device,prop)) == value:
+                self.skipped += 1
+                continue
+            self.mmc.setProperty(device,prop,value)
+            self.state[(device,prop)] = value
+            self.issued += 1
+
+    def invalidate(self,keys=None):
+        if keys is None:
+            self.state = {}
+        else:
+            for key in keys:
+                self.state.pop(key,None)
+
+    def sync(self):
+        for device,prop in list(self.state):
+            self.state[(device,prop)] = self.mmc.getProperty(device,prop)
+
+    def counters(self):
+        return {"issued":self.issued,"skipped":self.skipped}
+
 class scopeCore:
-    def __init__(self,configpath,logpath,camera_name="BSI Prime",shutter_name="SpectraIII",xystage_name="XYStage",focus_name="ZDrive",fish_channel_group="FISH_channels"):
-        self.mmc = pymmcore.CMMCore()
+    def __init__(self,configpath,logpath,camera_name="BSI Prime",shutter_name="SpectraIII",xystage_name="XYStage",focus_name="ZDrive",fish_channel_group="FISH_channels",\
+                 wait_timeout=30.,blocking_waits=False,config_cache=False,pfs_name="PFS",pfs_offset_name="PFSOffset",\
+                 pfs_status_property="PFS Status",pfs_locked_value="Locked in focus",pfs_timeout=5.,pfs_settle_secs=0.25,mmc=None):
+        self.mmc = pymmcore.CMMCore() if mmc is None else mmc
         self.mmc.loadSystemConfiguration(configpath)
         self.mmc.setPrimaryLogFile(logpath)
         self.mmc.setCameraDevice(camera_name)
@@ -79,15 +343,27 @@ class scopeCore:
         self.shutter_name = shutter_name
         self.xystage_name = xystage_name
         self.focus_name = focus_name
+        self.waiter = deviceWaiter(self.mmc,timeout=wait_timeout,blocking=blocking_waits)
+        self.config_cache = configCache(self.mmc) if config_cache else None
+
+        self.pfs_name = pfs_name
+        self.pfs_offset_name = pfs_offset_name
+        self.pfs_status_property = pfs_status_property
+        self.pfs_locked_value = pfs_locked_value
+        self.pfs_timeout = pfs_timeout
+        ### Fixed PFS settle time used when there is no lock status to poll ###
+        self.pfs_settle_secs = pfs_settle_secs
+        self.moved_since_pfs = True
+        self.profiler = acqProfiler(enabled=False)
+        self.frame_pool = framePool()
 
     def snap_image(self,img_size=(12,12)):
         self.mmc.snapImage()
         im1 = self.mmc.getImage()
         return im1
 
-    def auto_contrast(self,img,low_percentile=0,high_percentile=100):
-        low = np.percentile(img,low_percentile)
-        high = np.percentile(img,high_percentile)
+    def auto_contrast(self,img,low_percentile=0,high_percentile=100,stride=1):
+        low,high = histogram_percentiles(img,[low_percentile,high_percentile],stride=stride)
         return low,high
 
     def plot_img(self,img,low,high,img_size=(12,12)):
@@ -96,12 +372,15 @@ class scopeCore:
         plt.imshow(img, interpolation='None',vmin=low,vmax=high)
         plt.show()
         
-    def liveview(self,img_size=(12,12),low=None,high=None):#W,interval=0.5):
+    def liveview(self,img_size=(12,12),low=None,high=None,continuous=True,display_shape=(1024,1024),interval_ms=0.,duration=None,\
+                 low_percentile=0.5,high_percentile=99.5,smoothing=0.8):#W,interval=0.5):
+        if continuous:
+            return self.continuous_liveview(img_size=img_size,low=low,high=high,display_shape=display_shape,interval_ms=interval_ms,duration=duration,\
+                                            low_percentile=low_percentile,high_percentile=high_percentile,smoothing=smoothing)
         while True:
             try:
-                while self.mmc.deviceBusy(self.camera_name):
-                    time.sleep(0.005)
-                    
+                self.waiter.wait(self.camera_name,record=False)
+
                 im1 = self.snap_image()
                 clear_output(wait = True)
                 plt.figure(figsize=img_size)
@@ -112,8 +391,53 @@ class scopeCore:
                 plt.show()
             except KeyboardInterrupt:
                 break
-        while self.mmc.deviceBusy(self.camera_name):
-            time.sleep(0.01)
+        self.waiter.wait(self.camera_name,record=False)
+
+    def continuous_liveview(self,img_size=(12,12),low=None,high=None,display_shape=(1024,1024),interval_ms=0.,duration=None,\
+                            low_percentile=0.5,high_percentile=99.5,smoothing=0.8):
+        ### Streams from the circular buffer into one persistent image artist; only the newest frame is drawn, older ones are dropped ###
+        self.waiter.wait(self.camera_name,record=False)
+        fig,ax = plt.subplots(figsize=img_size)
+        ax.set_axis_off()
+        artist = None
+        handle = display(fig,display_id=True) if "inline" in matplotlib.get_backend() else None
+        if handle is not None:
+            plt.close(fig)
+        else:
+            plt.show(block=False)
+
+        contrast = contrastTracker(low_percentile=low_percentile,high_percentile=high_percentile,smoothing=smoothing)
+        frames_displayed = 0
+        ti = time.perf_counter()
+        self.mmc.startContinuousSequenceAcquisition(interval_ms)
+        try:
+            while duration is None or time.perf_counter()-ti < duration:
+                if self.mmc.getRemainingImageCount() == 0:
+                    sleep(0.001)
+                    continue
+                img = self.mmc.getLastImage()
+                self.mmc.clearCircularBuffer()
+                frame = downsample(img,display_shape)
+                frame_low,frame_high = contrast.update(frame) if low is None or high is None else (low,high)
+
+                if artist is None:
+                    artist = ax.imshow(frame,interpolation='None',cmap="gray",vmin=frame_low,vmax=frame_high)
+                else:
+                    artist.set_data(frame)
+                    artist.set_clim(frame_low,frame_high)
+                if handle is not None:
+                    handle.update(fig)
+                else:
+                    fig.canvas.draw_idle()
+                    fig.canvas.flush_events()
+                frames_displayed += 1
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.mmc.stopSequenceAcquisition()
+            self.waiter.wait(self.camera_name,record=False)
+        t_elapsed = time.perf_counter()-ti
+        return {"frames_displayed":frames_displayed,"display_fps":frames_displayed/t_elapsed}
             
     def set_grid(self,num_col,num_row,col_step=333.,row_step=686.):
         grid_coords = []
@@ -140,7 +464,104 @@ class scopeCore:
         return grid_coords
     
     
-    def multipoint_aq(self,grid_coords,config_list,timepoint,output_folder="./",group_name="FISH_channels"):
+    def config_settings(self,group_name,config):
+        if self.config_cache is not None:
+            return self.config_cache.get_settings(group_name,config)
+        return read_config_settings(self.mmc,group_name,config)
+
+    def set_config(self,group_name,config):
+        if self.config_cache is not None:
+            self.config_cache.apply(group_name,config)
+        else:
+            self.mmc.setConfig(group_name,config)
+
+    def config_switch_cost(self,from_settings,to_settings,device_weights={}):
+        cost = 0.
+        for key in set(from_settings) | set(to_settings):
+            if from_settings.get(key) != to_settings.get(key):
+                device = key[0]
+                if device in device_weights:
+                    cost += device_weights[device]
+                elif self.mmc.getDeviceType(device) == pymmcore.StateDevice:
+                    cost += 10.
+                else:
+                    cost += 1.
+        return cost
+
+    def plan_channel_order(self,group_name,config_list,device_weights={},max_exhaustive=8):
+        ### Orders channels so that slow devices (filter turrets, wheels) change as few times as possible ###
+        settings = [self.config_settings(group_name,config) for config in config_list]
+        num_configs = len(config_list)
+        costs = np.array([[self.config_switch_cost(settings[i],settings[j],device_weights=device_weights) for j in range(num_configs)] for i in range(num_configs)])
+
+        def order_cost(order):
+            return sum(costs[order[k],order[k+1]] for k in range(len(order)-1))
+
+        if num_configs <= max_exhaustive:
+            best_order = min(itertools.permutations(range(num_configs)),key=order_cost)
+        else:
+            orders = []
+            for start in range(num_configs):
+                order = [start]
+                while len(order) < num_configs:
+                    remaining = [idx for idx in range(num_configs) if idx not in order]
+                    order.append(min(remaining,key=lambda idx: costs[order[-1],idx]))
+                orders.append(order)
+            best_order = min(orders,key=order_cost)
+        return [config_list[idx] for idx in best_order]
+
+    def sequence_plan(self,group_name,config_list):
+        ### Returns per-property value sequences for config_list, or None if a changing property can't be hardware sequenced ###
+        if len(set("noPFS" in config for config in config_list)) > 1:
+            return None
+        settings = [self.config_settings(group_name,config) for config in config_list]
+        keys = set().union(*settings)
+        sequences = {}
+        for device,prop in keys:
+            values = [setting.get((device,prop)) for setting in settings]
+            if None in values:
+                return None
+            if len(set(values)) == 1:
+                continue
+            if device == self.camera_name and prop == "Exposure":
+                if not self.mmc.isExposureSequenceable(device):
+                    return None
+                max_length = self.mmc.getExposureSequenceMaxLength(device)
+            else:
+                if not self.mmc.isPropertySequenceable(device,prop):
+                    return None
+                max_length = self.mmc.getPropertySequenceMaxLength(device,prop)
+            if max_length < len(values):
+                return None
+            sequences[(device,prop)] = values
+        return sequences
+
+    def load_sequences(self,sequences):
+        for (device,prop),values in sequences.items():
+            if device == self.camera_name and prop == "Exposure":
+                self.mmc.loadExposureSequence(device,[float(value) for value in values])
+            else:
+                self.mmc.loadPropertySequence(device,prop,list(values))
+
+    def start_sequences(self,sequences):
+        for device,prop in sequences:
+            if device == self.camera_name and prop == "Exposure":
+                self.mmc.startExposureSequence(device)
+            else:
+                self.mmc.startPropertySequence(device,prop)
+
+    def stop_sequences(self,sequences):
+        for device,prop in sequences:
+            if device == self.camera_name and prop == "Exposure":
+                self.mmc.stopExposureSequence(device)
+            else:
+                self.mmc.stopPropertySequence(device,prop)
+        if self.config_cache is not None:
+            self.config_cache.invalidate(sequences.keys())
+
+    def multipoint_aq(self,grid_coords,config_list,timepoint,output_folder="./",group_name="FISH_channels",streaming=False,queue_size=8,store=None,\
+                      sequenced=False,fov_ids=None,pipelined=False,channel_order="fixed",focus_map=None,profiler=None,journal=None,\
+                      compress_threads=4):
         
         ### Make sure configs are valid ###
         undefined_configs = []
@@ -151,42 +572,217 @@ class scopeCore:
         
         if len(undefined_configs) > 0:
             raise ValueError("The following configs are undefined: " + ", ".join(undefined_configs))
+
+        ### Properties may have been changed outside the cache since the last timepoint (liveview, manual focusing), so the first preset is written in full ###
+        if self.config_cache is not None:
+            self.config_cache.invalidate()
             
+        ### On resume, FOVs with every config already journaled are dropped; partially acquired FOVs are re-acquired ###
+
+        completed = {} if journal is None else journal.completed_frames(timepoint)
+        if len(completed) > 0:
+            fov_nums = list(range(len(grid_coords))) if fov_ids is None else list(fov_ids)
+            remaining = [fov_idx for fov_idx,fov_num in enumerate(fov_nums) if any((fov_num,config) not in completed for config in config_list)]
+            grid_coords = [grid_coords[fov_idx] for fov_idx in remaining]
+            fov_ids = [fov_nums[fov_idx] for fov_idx in remaining]
+            completed = {key:metadata_entry for key,metadata_entry in completed.items() if key[0] not in fov_ids}
+            print("Resuming timepoint " + str(timepoint) + ": " + str(len(fov_nums)-len(remaining)) + " FOVs already acquired.")
+
         ### Gather basic metadata ###
             
         t_start = time.time()
         x_dim = self.mmc.getProperty(self.camera_name,"X-dimension")
         y_dim = self.mmc.getProperty(self.camera_name,"Y-dimension")
+
+        ### Frames that need converting to the storage dtype are copied into pooled buffers, so allocate those before the first FOV ###
+        if streaming and self.mmc.getBytesPerPixel() != self.frame_pool.dtype.itemsize:
+            self.frame_pool.preallocate((int(y_dim),int(x_dim)))
+
+        ### Snake channel order reverses config_list on odd FOVs so consecutive FOVs share a channel and skip the reset ###
+
+        if channel_order == "optimized":
+            config_list = self.plan_channel_order(group_name,config_list)
+        elif channel_order not in ("fixed","snake"):
+            raise ValueError("Channel order not recognized")
+
+        ### Use hardware-triggered channel sequences when every changing property supports it ###
+
+        sequences = None
+        if sequenced and len(grid_coords) > 0:
+            sequences = self.sequence_plan(group_name,config_list)
+            if sequences is None:
+                print("Config group " + group_name + " can't be hardware sequenced, falling back to per-config acquisition.")
+            else:
+                self.set_config(group_name,config_list[0])
+                self.waiter.wait(label="sequence")
+                self.load_sequences(sequences)
         
-        ## Note change the write to disk later ##
+        if store is None:
+            store = fileStore(output_folder)
+        if profiler is not None:
+            self.profiler = profiler
+            self.profiler.set_context(t=timepoint)
+        if streaming:
+            writer = streamWriter(store,queue_size=queue_size,profiler=self.profiler,on_write=None if journal is None else journal.record_frame,\
+                                  pool=self.frame_pool,compress_threads=compress_threads)
                 
         imgs = []
-        imgs_metadata = []
+        imgs_metadata = [metadata_entry for key,metadata_entry in sorted(completed.items())]
+        num_completed = len(imgs_metadata)
+
+        def emit(img,metadata_entry):
+            img = self.frame_pool.take(img)
+            if streaming:
+                writer.put(img,metadata_entry,timepoint)
+            else:
+                imgs.append(img)
+            imgs_metadata.append(metadata_entry)
+        
+        if len(grid_coords) > 0:
+            x_coord,y_coord = grid_coords[0]
+            self.move_to(x_coord,y_coord)
+
+        try:
+            for fov_idx,(x_coord,y_coord) in enumerate(grid_coords):
+                fov_num = fov_idx if fov_ids is None else fov_ids[fov_idx]
+                if not pipelined or fov_idx == 0:
+                    with self.profiler.phase("move",fov=fov_num):
+                        self.waiter.wait(self.xystage_name,label="move")
+                        self.move_to(x_coord,y_coord)
+
+                ### In pipelined mode the move to the next FOV is issued right after the last exposure of this one ###
+                next_move = None
+                if pipelined:
+                    with self.profiler.phase("move",fov=fov_num):
+                        self.waiter.wait(self.xystage_name,label="move")
+                    if fov_idx+1 < len(grid_coords):
+                        next_move = partial(self.move_to,*grid_coords[fov_idx+1])
+
+                if sequences is None:
+                    if channel_order != "fixed" and fov_idx % 2 == 1:
+                        fov_configs = config_list[::-1]
+                    else:
+                        fov_configs = config_list
+                    self.acquire_configs(fov_num,fov_configs,group_name,t_start,emit,next_move=next_move,pipelined=pipelined,\
+                                         reset=(channel_order == "fixed"),focus_map=focus_map)
+                else:
+                    self.acquire_sequence(fov_num,config_list,sequences,t_start,emit,next_move=next_move,pipelined=pipelined,focus_map=focus_map)
+        finally:
+            if streaming:
+                writer.close()
+        if len(grid_coords) > 0:
+            x_coord,y_coord = grid_coords[0]
+            self.move_to(x_coord,y_coord)
+                
+        ### Frames buffered for a compressing store are compressed in parallel before the sequential writes ###
+        codec = getattr(store,"codec",None)
+        if codec is not None and len(imgs) > 0 and compress_threads > 0:
+            with ThreadPoolExecutor(max_workers=compress_threads) as executor:
+                compressed = list(executor.map(codec.compress,imgs))
+        else:
+            compressed = imgs
+
+        for img_num in range(len(imgs)):
+            metadata_entry = imgs_metadata[num_completed+img_num]
+            with self.profiler.phase("write",fov=metadata_entry["fov"],config=metadata_entry["config"]):
+                store.write(compressed[img_num],metadata_entry,timepoint)
+            self.frame_pool.release(imgs[img_num])
+            if journal is not None:
+                journal.record_frame(metadata_entry,timepoint)
         
-        x_coord,y_coord = grid_coords[0]
+        store.write_metadata(imgs_metadata,timepoint)
+        counters = None if codec is None else codec.counters()
+        if counters is not None and counters["ratio"] is not None:
+            print("Compression (" + codec.codec + "): " + str(round(counters["ratio"],2)) + "x, " + \
+                  str(round(counters["MB_per_sec_per_thread"],1)) + " MB/s per thread x " + str(compress_threads) + " threads")
+
+        if profiler is not None:
+            profiler.save(output_folder + "timing_" + str(timepoint) + ".hdf5",t=timepoint)
+            profiler.clear_context("t")
+            self.profiler = acqProfiler(enabled=False)
+
+    def move_to(self,x_coord,y_coord):
         self.mmc.setXYPosition(x_coord,y_coord)
+        self.moved_since_pfs = True
+
+    def pfs_locked(self):
+        if self.mmc.hasProperty(self.pfs_name,self.pfs_status_property):
+            return self.mmc.getProperty(self.pfs_name,self.pfs_status_property) == self.pfs_locked_value
+        if self.mmc.getAutoFocusDevice() == self.pfs_name:
+            return self.mmc.isContinuousFocusLocked()
+        return None
+
+    def wait_pfs_lock(self):
+        ti = time.perf_counter()
+        locked = self.pfs_locked()
+        if locked is None:
+            time.sleep(self.pfs_settle_secs)
+            return True
+        interval = 0.005
+        while not locked:
+            if time.perf_counter()-ti > self.pfs_timeout:
+                print("PFS did not lock within " + str(self.pfs_timeout) + " s.")
+                break
+            time.sleep(interval)
+            interval = min(interval*2,0.05)
+            locked = self.pfs_locked()
+        self.waiter.waits.append({"device":self.pfs_name,"label":"pfs lock","duration":time.perf_counter()-ti})
+        return locked
+
+    def engage_pfs(self,config,fov_num=None,focus_map=None):
+        if "noPFS" in config:
+            return
+        if focus_map is None:
+            self.mmc.setProperty(self.pfs_name,"FocusMaintenance","On")
+            time.sleep(self.pfs_settle_secs)
+            return
+
+        ### With a focus map, PFS is only re-engaged after an XY move, starting from the predicted focus ###
+        if not self.moved_since_pfs and self.mmc.getProperty(self.pfs_name,"FocusMaintenance") == "On":
+            return
+        x_coord,y_coord = self.mmc.getXYPosition(self.xystage_name)
+        prediction = focus_map.predict(fov_num,x_coord,y_coord)
+        if prediction is not None:
+            z_coord,pfs_offset = prediction
+            if pfs_offset is not None:
+                self.mmc.setPosition(self.pfs_offset_name,pfs_offset)
+            self.mmc.setPosition(self.focus_name,z_coord)
+            self.waiter.wait(self.focus_name,label="focus")
+        self.mmc.setProperty(self.pfs_name,"FocusMaintenance","On")
+        locked = self.wait_pfs_lock()
+        self.moved_since_pfs = False
+        if locked:
+            focus_map.record(fov_num,x_coord,y_coord,self.mmc.getPosition(self.focus_name),self.mmc.getPosition(self.pfs_offset_name))
+
+    def read_metadata(self,fov_num,config,t_start,xy=None,z=None):
+        if xy is None:
+            read_x_coord,read_y_coord = self.mmc.getXYPosition(self.xystage_name)
+        else:
+            read_x_coord,read_y_coord = xy
+        read_z_coord = self.mmc.getPosition(self.focus_name) if z is None else z
+        current_time = time.time()-t_start
+        return {"fov":fov_num,"config":config,"x":read_x_coord,"y":read_y_coord,"z":read_z_coord,"t":current_time}
+
+    def wait_config(self,group_name,config,label,devices_only=False):
+        ### While the stage is moving, systemBusy stays true; wait only on the devices the config touches instead ###
+        if not devices_only:
+            self.waiter.wait(label=label)
+            return
+        for device in set(device for device,prop in self.config_settings(group_name,config)):
+            self.waiter.wait(device,label=label)
 
-        for fov_num,(x_coord,y_coord) in enumerate(grid_coords):
-            while self.mmc.deviceBusy(self.xystage_name):
-                time.sleep(0.1)
-                pass
-            self.mmc.setXYPosition(x_coord,y_coord)                
+    def acquire_configs(self,fov_num,config_list,group_name,t_start,emit,next_move=None,pipelined=False,reset=True,focus_map=None):
+        xy = self.mmc.getXYPosition(self.xystage_name) if pipelined else None
+        for config_num,config in enumerate(config_list):
+            with self.profiler.phase("setConfig",fov=fov_num,config=config):
+                self.wait_config(group_name,config,"pre-config",devices_only=pipelined)
+                self.set_config(group_name,config)
+                self.wait_config(group_name,config,"config",devices_only=pipelined)
             
-            for config in config_list:
-                while self.mmc.systemBusy():
-                    time.sleep(0.1)
-                    pass
-                
-                self.mmc.setConfig(group_name,config)
-                    
-                while self.mmc.systemBusy():
-                    time.sleep(0.1)
-                    pass
+            with self.profiler.phase("pfs",fov=fov_num,config=config):
+                self.engage_pfs(config,fov_num,focus_map)
                 
-                if "noPFS" not in config:
-                    self.mmc.setProperty("PFS","FocusMaintenance","On")
-                    time.sleep(0.25)
-                    
+            with self.profiler.phase("snap",fov=fov_num,config=config):
                 shutter_failed = True
                 while shutter_failed:
                     try:
@@ -195,36 +791,58 @@ class scopeCore:
                         self.mmc.setShutterOpen(self.shutter_name,False)
                         shutter_failed = False
                     except:
+                        self.profiler.add("shutter retry",0.25,fov=fov_num,config=config)
                         time.sleep(0.25)
 
-                read_x_coord,read_y_coord = self.mmc.getXYPosition(self.xystage_name)
-                read_z_coord = self.mmc.getPosition(self.focus_name)
-                current_time = time.time()-t_start
-                
-                metadata_entry = {"fov":fov_num,"config":config,"x":read_x_coord,"y":read_y_coord,"z":read_z_coord,"t":current_time}
+            ### Positions are read before the next move starts, while PFS still holds this FOV's focus ###
+            metadata_entry = self.read_metadata(fov_num,config,t_start,xy=xy)
+            if next_move is not None and config_num == len(config_list)-1:
+                next_move()
+
+            with self.profiler.phase("getImage",fov=fov_num,config=config):
                 img = self.mmc.getImage()
-                
-                imgs.append(img)
-                imgs_metadata.append(metadata_entry)
-            while self.mmc.systemBusy():
-                time.sleep(0.1)
-                pass
-            self.mmc.setConfig(group_name,config_list[0])
-            while self.mmc.systemBusy():
-                time.sleep(0.1)
-                pass
-            if "noPFS" not in config_list[0]:
-                self.mmc.setProperty("PFS","FocusMaintenance","On")
-                time.sleep(0.25)
-        x_coord,y_coord = grid_coords[0]
-        self.mmc.setXYPosition(x_coord,y_coord)
-                
-        for img_num in range(len(imgs)):
-            img = imgs[img_num]
-            metadata_entry = imgs_metadata[img_num]
+            emit(img,metadata_entry)
+        if not reset:
+            return
+        with self.profiler.phase("setConfig",fov=fov_num,config=config_list[0]):
+            self.wait_config(group_name,config_list[0],"pre-config",devices_only=pipelined)
+            self.set_config(group_name,config_list[0])
+            self.wait_config(group_name,config_list[0],"config",devices_only=pipelined)
+        if focus_map is None:
+            with self.profiler.phase("pfs",fov=fov_num,config=config_list[0]):
+                self.engage_pfs(config_list[0])
 
-            with h5py.File(output_folder + "fov=" + str(metadata_entry["fov"]) + "_config=" + str(metadata_entry["config"]) + "_t=" + str(timepoint) + ".hdf5","w") as h5pyfile:
-                hdf5_dataset = h5pyfile.create_dataset("data", data=img, chunks=(128,128), dtype='uint16')
-        
-        metadata = pd.DataFrame.from_dict(imgs_metadata)
-        metadata.to_hdf(output_folder + "metadata_" + str(timepoint) + ".hdf5", key="data", mode="w")
\ No newline at end of file
+    def acquire_sequence(self,fov_num,config_list,sequences,t_start,emit,next_move=None,pipelined=False,focus_map=None):
+        xy = self.mmc.getXYPosition(self.xystage_name) if pipelined else None
+        self.waiter.wait(label="pre-sequence")
+        with self.profiler.phase("pfs",fov=fov_num):
+            self.engage_pfs(config_list[0],fov_num,focus_map)
+        ### Frames read out after next_move() would otherwise record z from the move to the next FOV ###
+        z = self.mmc.getPosition(self.focus_name) if pipelined else None
+
+        self.start_sequences(sequences)
+        self.mmc.setShutterOpen(self.shutter_name,True)
+        try:
+            self.mmc.startSequenceAcquisition(len(config_list),0.,True)
+            for config in config_list:
+                with self.profiler.phase("snap",fov=fov_num,config=config):
+                    while self.mmc.getRemainingImageCount() == 0:
+                        if not self.mmc.isSequenceRunning() and self.mmc.getRemainingImageCount() == 0:
+                            raise RuntimeError("Sequence acquisition stopped before all channels were read out.")
+                        time.sleep(0.001)
+                if next_move is not None and not self.mmc.isSequenceRunning():
+                    self.mmc.setShutterOpen(self.shutter_name,False)
+                    next_move()
+                    next_move = None
+                with self.profiler.phase("getImage",fov=fov_num,config=config):
+                    img = self.mmc.popNextImage()
+                    metadata_entry = self.read_metadata(fov_num,config,t_start,xy=xy,z=z)
+                emit(img,metadata_entry)
+            if next_move is not None:
+                self.mmc.stopSequenceAcquisition()
+                self.mmc.setShutterOpen(self.shutter_name,False)
+                next_move()
+        finally:
+            self.mmc.stopSequenceAcquisition()
+            self.mmc.setShutterOpen(self.shutter_name,False)
+            self.stop_sequences(sequences)
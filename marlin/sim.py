@@ -0,0 +1,461 @@
+import time
+import threading
+from collections import deque
+import numpy as np
+import pymmcore
+import serial
+
+default_latencies = {"property":0.005,"state_device":0.15,"xy_speed":5000.,"xy_settle":0.05,"z_speed":500.,"pfs_lock":0.1,\
+                     "readout":0.03,"serial_command":0.005,"i2c_valve":0.01,"titanx_move":0.3}
+
+def load_demo_core(mm_path,config_name="MMConfig_demo.cfg"):
+    ### Real pymmcore core driven by Micro-Manager's demo adapters, for when an MM install is available ###
+    mmc = pymmcore.CMMCore()
+    mmc.setDeviceAdapterSearchPaths([mm_path])
+    mmc.loadSystemConfiguration(mm_path + "/" + config_name)
+    return mmc
+
+class simSetting:
+    def __init__(self,device,prop,value):
+        self.device = device
+        self.prop = prop
+        self.value = value
+
+    def getDeviceLabel(self):
+        return self.device
+
+    def getPropertyName(self):
+        return self.prop
+
+    def getPropertyValue(self):
+        return self.value
+
+class simConfiguration:
+    def __init__(self,settings):
+        self.settings = settings
+
+    def size(self):
+        return len(self.settings)
+
+    def getSetting(self,setting_num):
+        return simSetting(*self.settings[setting_num])
+
+class simCore:
+    def __init__(self,latencies={},time_scale=1.,image_shape=(512,512),sequenceable_devices=(),pfs_name="PFS",seed=0):
+        ### Stand-in for pymmcore.CMMCore covering the calls scopeCore makes; devices stay busy for their configured latency ###
+        self.latencies = dict(default_latencies)
+        self.latencies.update(latencies)
+        self.time_scale = time_scale
+        self.image_shape = image_shape
+        self.sequenceable_devices = set(sequenceable_devices)
+        self.pfs_name = pfs_name
+
+        self.properties = {}
+        self.state_devices = set()
+        self.configs = {}
+        self.busy_until = {}
+        self.prop_sequences = {}
+        self.timeout_ms = 5000
+        self.camera_name = ""
+        self.focus_name = ""
+        self.autofocus_name = ""
+        self.xystage_name = "XYStage"
+        self.xy = (0.,0.)
+        self.positions = {}
+        self.shutters = {}
+        self.pfs_lock_time = None
+
+        self.frame = np.random.default_rng(seed).integers(90,110,size=image_shape,dtype=np.uint16)
+        self.last_image = None
+        self.sequence = deque()
+        self.sequence_end = 0.
+        self.continuous = False
+        self.next_continuous = 0.
+
+        self.counters = {"setProperty":0,"setConfig":0,"setXYPosition":0,"snapImage":0}
+
+    def now(self):
+        return time.perf_counter()
+
+    def sleep(self,secs):
+        if secs > 0:
+            time.sleep(secs*self.time_scale)
+
+    def latency(self,device):
+        if device in self.latencies:
+            return self.latencies[device]
+        if device in self.state_devices:
+            return self.latencies["state_device"]
+        return self.latencies["property"]
+
+    def make_busy(self,device,secs):
+        self.busy_until[device] = max(self.busy_until.get(device,0.),self.now()) + secs*self.time_scale
+
+    ### Configuration ###
+
+    def loadSystemConfiguration(self,configpath):
+        with open(configpath,"r") as infile:
+            lines = infile.read().split("\n")
+        for line in lines:
+            fields = line.strip().split(",")
+            if fields[0] == "Property" and len(fields) >= 4:
+                if fields[1] == "Core":
+                    self.set_core_property(fields[2],fields[3])
+                else:
+                    self.properties[(fields[1],fields[2])] = ",".join(fields[3:])
+            elif fields[0] == "Label" and len(fields) >= 4:
+                self.state_devices.add(fields[1])
+            elif fields[0] == "ConfigGroup" and len(fields) >= 6:
+                group = self.configs.setdefault(fields[1],{})
+                group.setdefault(fields[2],[]).append((fields[3],fields[4],",".join(fields[5:])))
+
+    def set_core_property(self,prop,value):
+        if prop == "Camera":
+            self.camera_name = value
+        elif prop == "Focus":
+            self.focus_name = value
+        elif prop == "XYStage":
+            self.xystage_name = value
+        elif prop == "AutoFocus":
+            self.autofocus_name = value
+
+    def setPrimaryLogFile(self,logpath):
+        pass
+
+    def setCameraDevice(self,camera_name):
+        self.camera_name = camera_name
+
+    def getCameraDevice(self):
+        return self.camera_name
+
+    def getAutoFocusDevice(self):
+        return self.autofocus_name
+
+    def getTimeoutMs(self):
+        return self.timeout_ms
+
+    def setTimeoutMs(self,timeout_ms):
+        self.timeout_ms = timeout_ms
+
+    def getDeviceType(self,device):
+        if device in self.state_devices:
+            return pymmcore.StateDevice
+        return pymmcore.GenericDevice
+
+    def isConfigDefined(self,group_name,config):
+        return config in self.configs.get(group_name,{})
+
+    def getConfigData(self,group_name,config):
+        return simConfiguration(self.configs[group_name][config])
+
+    def setConfig(self,group_name,config):
+        self.counters["setConfig"] += 1
+        for device,prop,value in self.configs[group_name][config]:
+            self.setProperty(device,prop,value)
+
+    ### Properties ###
+
+    def hasProperty(self,device,prop):
+        if device == self.pfs_name and prop == "PFS Status":
+            return True
+        return (device,prop) in self.properties
+
+    def getProperty(self,device,prop):
+        if device == self.pfs_name and prop == "PFS Status":
+            return "Locked in focus" if self.isContinuousFocusLocked() else "Focus lock off"
+        if device == self.camera_name and prop == "X-dimension":
+            return str(self.image_shape[1])
+        if device == self.camera_name and prop == "Y-dimension":
+            return str(self.image_shape[0])
+        return self.properties.get((device,prop),"")
+
+    def setProperty(self,device,prop,value):
+        self.counters["setProperty"] += 1
+        self.properties[(device,prop)] = str(value)
+        self.make_busy(device,self.latency(device))
+        if device == self.pfs_name and prop == "FocusMaintenance":
+            if str(value) == "On":
+                self.pfs_lock_time = self.now() + self.latencies["pfs_lock"]*self.time_scale
+            else:
+                self.pfs_lock_time = None
+
+    def isContinuousFocusLocked(self):
+        return self.pfs_lock_time is not None and self.now() >= self.pfs_lock_time
+
+    def isPropertySequenceable(self,device,prop):
+        return device in self.sequenceable_devices
+
+    def getPropertySequenceMaxLength(self,device,prop):
+        return 1000
+
+    def isExposureSequenceable(self,device):
+        return device in self.sequenceable_devices
+
+    def getExposureSequenceMaxLength(self,device):
+        return 1000
+
+    def loadPropertySequence(self,device,prop,values):
+        self.prop_sequences[(device,prop)] = list(values)
+
+    def loadExposureSequence(self,device,values):
+        self.prop_sequences[(device,"Exposure")] = [str(value) for value in values]
+
+    def startPropertySequence(self,device,prop):
+        pass
+
+    def stopPropertySequence(self,device,prop):
+        pass
+
+    def startExposureSequence(self,device):
+        pass
+
+    def stopExposureSequence(self,device):
+        pass
+
+    ### Busy state ###
+
+    def deviceBusy(self,device):
+        return self.now() < self.busy_until.get(device,0.)
+
+    def systemBusy(self):
+        now = self.now()
+        return any(now < busy_until for busy_until in self.busy_until.values())
+
+    def waitForDevice(self,device):
+        remaining = self.busy_until.get(device,0.) - self.now()
+        if remaining > self.timeout_ms/1000.:
+            raise RuntimeError("Wait for device " + device + " timed out")
+        if remaining > 0:
+            time.sleep(remaining)
+
+    def waitForSystem(self):
+        for device in list(self.busy_until):
+            self.waitForDevice(device)
+
+    ### Stages ###
+
+    def setXYPosition(self,*args):
+        x_coord,y_coord = args[-2:]
+        dist = np.hypot(x_coord-self.xy[0],y_coord-self.xy[1])
+        self.counters["setXYPosition"] += 1
+        self.make_busy(self.xystage_name,dist/self.latencies["xy_speed"] + self.latencies["xy_settle"])
+        self.xy = (float(x_coord),float(y_coord))
+        if self.pfs_lock_time is not None:
+            self.pfs_lock_time = self.busy_until[self.xystage_name] + self.latencies["pfs_lock"]*self.time_scale
+
+    def getXYPosition(self,*args):
+        return self.xy
+
+    def setPosition(self,*args):
+        label = self.focus_name if len(args) == 1 else args[0]
+        position = float(args[-1])
+        dist = abs(position-self.positions.get(label,0.))
+        self.positions[label] = position
+        self.make_busy(label,dist/self.latencies["z_speed"])
+
+    def getPosition(self,*args):
+        label = self.focus_name if len(args) == 0 else args[0]
+        return self.positions.get(label,0.)
+
+    ### Camera ###
+
+    def exposure_secs(self):
+        return float(self.properties.get((self.camera_name,"Exposure"),"10"))/1000.
+
+    def setShutterOpen(self,*args):
+        self.shutters[args[0] if len(args) == 2 else ""] = args[-1]
+
+    def snapImage(self):
+        self.counters["snapImage"] += 1
+        self.sleep(self.exposure_secs())
+        self.last_image = self.frame
+
+    def getImage(self):
+        self.sleep(self.latencies["readout"])
+        return self.last_image.copy()
+
+    def getBytesPerPixel(self):
+        return self.frame.dtype.itemsize
+
+    def startSequenceAcquisition(self,num_images,interval_ms,stop_on_overflow):
+        exposures = self.prop_sequences.get((self.camera_name,"Exposure"),[str(self.exposure_secs()*1000.)])
+        t = self.now()
+        self.sequence = deque()
+        for img_num in range(num_images):
+            t += (float(exposures[img_num % len(exposures)])/1000. + self.latencies["readout"])*self.time_scale
+            self.sequence.append(t)
+        self.sequence_end = t
+
+    def startContinuousSequenceAcquisition(self,interval_ms):
+        self.continuous = True
+        self.next_continuous = self.now() + (self.exposure_secs() + self.latencies["readout"])*self.time_scale
+
+    def isSequenceRunning(self):
+        return self.continuous or self.now() < self.sequence_end
+
+    def getRemainingImageCount(self):
+        if self.continuous:
+            return 1 if self.now() >= self.next_continuous else 0
+        now = self.now()
+        return sum(1 for ready_time in self.sequence if ready_time <= now)
+
+    def popNextImage(self):
+        if self.continuous:
+            return self.getLastImage()
+        if len(self.sequence) == 0 or self.sequence[0] > self.now():
+            raise RuntimeError("Circular buffer is empty")
+        self.sequence.popleft()
+        return self.frame.copy()
+
+    def getLastImage(self):
+        if self.continuous:
+            self.next_continuous = max(self.next_continuous,self.now()) + (self.exposure_secs() + self.latencies["readout"])*self.time_scale
+        return self.frame.copy()
+
+    def clearCircularBuffer(self):
+        self.sequence = deque()
+
+    def stopSequenceAcquisition(self):
+        self.continuous = False
+        self.sequence = deque()
+        self.sequence_end = 0.
+
+class simArduino:
+    def __init__(self,port="COM3",latencies={},time_scale=1.,num_titanx=5,firmware_version=3,valve_fail_rate=0.,seed=0):
+        ### Model of Liquid_Handler.ino: commands are processed in order, each finishing after its simulated latency ###
+        self.port = port
+        self.latencies = dict(default_latencies)
+        self.latencies.update(latencies)
+        self.time_scale = time_scale
+        self.firmware_version = firmware_version
+        self.valve_fail_rate = valve_fail_rate
+        self.rng = np.random.default_rng(seed)
+        self.valvestate = 0
+        self.pumpstate = 0
+        self.titanxstates = [0 for i in range(num_titanx)]
+        self.free_at = 0.
+        self.lock = threading.Lock()
+        self.counters = {"commands":0,"scans":0}
+
+    def serial_class(self):
+        def open_port(port,baudrate=9600,timeout=None):
+            if port != self.port:
+                raise serial.SerialException("could not open port " + str(port))
+            return simSerial(self,timeout=timeout)
+        return open_port
+
+    def process(self,line):
+        ### Returns (response, seconds the firmware spends on the line) ###
+        self.counters["commands"] += 1
+        if line.startswith("#") and ":" in line and self.firmware_version >= 3:
+            seq,line = line[1:].split(":",1)
+            response,latency,ok = self.run_command(line)
+            return response + (seq + (":OK" if ok else ":ERR") + "\r\n").encode("ascii"),latency
+        response,latency,ok = self.run_command(line)
+        return response,latency
+
+    def run_command(self,line):
+        ### Returns (response, latency, ok) like runcommand() in the firmware ###
+        latency = self.latencies["serial_command"]
+        if len(line) == 0:
+            return b"",latency,False
+        cmd = line[0]
+        if cmd == "0" and len(line) == 1:
+            response,scan_latency = self.scan()
+            return response,latency + scan_latency,True
+        if cmd == "2" and len(line) == 4:
+            addrint = int(line[1:2])
+            titanxstate = int(line[2:4])
+            if self.rng.random() < self.valve_fail_rate:
+                return b"",latency,False
+            ### setvalve() polls the valve over I2C and only acks once it reports the new position ###
+            latency += self.latencies["i2c_valve"]
+            if self.titanxstates[addrint] != titanxstate:
+                latency += self.latencies["titanx_move"]
+            self.titanxstates[addrint] = titanxstate
+            return b"",latency,True
+        if cmd == "3" and len(line) == 5:
+            self.pumpstate = int(line[1:5])
+            return b"",latency,True
+        if cmd == "4" and len(line) == 2:
+            self.valvestate = int(line[1:2])
+            return b"",latency,True
+        if cmd == "5" and len(line) == 1:
+            return b"MARLIN",latency,True
+        if cmd == "6" and len(line) == 16 and self.firmware_version >= 2:
+            valvestate = int(line[1:2])
+            pumpstate = int(line[2:6])
+            titanxstates = [int(line[6+2*i:8+2*i]) for i in range(len(self.titanxstates))]
+            if valvestate not in (0,1) or pumpstate > 4095 or max(titanxstates) > 12:
+                return b"ERR\r\n",latency,False
+            self.valvestate = valvestate
+            self.pumpstate = pumpstate
+            ### As with '2', each moved valve is polled until it reaches position before the scan is sent back ###
+            reached = True
+            for addrint,titanxstate in enumerate(titanxstates):
+                if titanxstate != 0:
+                    if self.rng.random() < self.valve_fail_rate:
+                        reached = False
+                        continue
+                    latency += self.latencies["i2c_valve"]
+                    if self.titanxstates[addrint] != titanxstate:
+                        latency += self.latencies["titanx_move"]
+                    self.titanxstates[addrint] = titanxstate
+            response,scan_latency = self.scan()
+            return response,latency + scan_latency,reached
+        if cmd == "7" and len(line) == 1 and self.firmware_version >= 2:
+            return b"MARLIN" + str(self.firmware_version).encode("ascii") + b"\r\n",latency,True
+        return b"",latency,False
+
+    def scan(self):
+        self.counters["scans"] += 1
+        response = "[" + ",".join(str(state) for state in self.titanxstates) + "];" + str(self.valvestate) + ";" + str(self.pumpstate) + "\r\n"
+        return response.encode("ascii"),self.latencies["i2c_valve"]*len(self.titanxstates)
+
+class simSerial:
+    def __init__(self,arduino,timeout=None):
+        self.arduino = arduino
+        self.timeout = timeout
+        self.inbuffer = b""
+        self.outbuffer = deque()
+        self.is_open = True
+
+    def write(self,data):
+        self.inbuffer += data
+        while b"\n" in self.inbuffer:
+            line,self.inbuffer = self.inbuffer.split(b"\n",1)
+            with self.arduino.lock:
+                response,latency = self.arduino.process(line.decode("ascii").strip("\r"))
+                self.arduino.free_at = max(self.arduino.free_at,time.perf_counter()) + latency*self.arduino.time_scale
+                if len(response) > 0:
+                    self.outbuffer.append((self.arduino.free_at,response))
+        return len(data)
+
+    def read_until(self,expected=b"\n"):
+        deadline = None if self.timeout is None else time.perf_counter() + self.timeout
+        received = b""
+        while True:
+            now = time.perf_counter()
+            while len(self.outbuffer) > 0 and self.outbuffer[0][0] <= now:
+                received += self.outbuffer.popleft()[1]
+            if expected in received:
+                idx = received.index(expected) + len(expected)
+                if idx < len(received):
+                    self.outbuffer.appendleft((now,received[idx:]))
+                return received[:idx]
+            if deadline is not None and now >= deadline:
+                return received
+            if len(self.outbuffer) > 0:
+                wait = self.outbuffer[0][0] - now
+            else:
+                wait = 0.001 if deadline is None else deadline - now
+            time.sleep(max(min(wait,0.01),0.))
+
+    def reset_input_buffer(self):
+        self.outbuffer = deque()
+
+    def reset_output_buffer(self):
+        pass
+
+    def close(self):
+        self.is_open = False
@@ -0,0 +1,374 @@
+import os
+import time
+import threading
+import queue
+import json
+import zlib
+import numpy as np
+import h5py
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from .profiler import acqProfiler
+
+try:
+    import blosc
+    import hdf5plugin
+except ImportError:
+    blosc = None
+    hdf5plugin = None
+
+class compressedFrame:
+    def __init__(self,data,shape,dtype,raw_nbytes):
+        self.data = data
+        self.shape = shape
+        self.dtype = dtype
+        self.raw_nbytes = raw_nbytes
+
+class frameCodec:
+    def __init__(self,codec="blosc-lz4",level=5,shuffle=True):
+        ### Compresses whole frames into the exact chunk format of the matching HDF5 filter, so they can be written with write_direct_chunk ###
+        ### Blosc needs both the blosc and hdf5plugin packages; without them the built-in gzip filter (zlib releases the GIL) is used ###
+        if codec.startswith("blosc") and blosc is None:
+            print("blosc/hdf5plugin not installed, falling back to gzip compression.")
+            codec = "gzip"
+        if codec not in ("gzip","blosc-lz4","blosc-lz4hc","blosc-zstd","blosc-zlib"):
+            raise ValueError("Codec not recognized")
+        self.codec = codec
+        self.level = level
+        self.shuffle = shuffle
+        self.lock = threading.Lock()
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+        self.compress_secs = 0.
+
+    def dataset_kwargs(self):
+        if self.codec == "gzip":
+            return {"compression":"gzip","compression_opts":self.level,"shuffle":self.shuffle}
+        shuffle = hdf5plugin.Blosc.BITSHUFFLE if self.shuffle else hdf5plugin.Blosc.NOSHUFFLE
+        return dict(hdf5plugin.Blosc(cname=self.codec.split("-")[1],clevel=self.level,shuffle=shuffle))
+
+    def compress(self,img):
+        ti = time.perf_counter()
+        img = np.ascontiguousarray(img)
+        if self.codec == "gzip":
+            raw = img.view(np.uint8).reshape(-1,img.itemsize).T.tobytes() if self.shuffle else img.tobytes()
+            data = zlib.compress(raw,self.level)
+        else:
+            shuffle = blosc.BITSHUFFLE if self.shuffle else blosc.NOSHUFFLE
+            data = blosc.compress(img.tobytes(),typesize=img.itemsize,clevel=self.level,shuffle=shuffle,cname=self.codec.split("-")[1])
+        with self.lock:
+            self.raw_bytes += img.nbytes
+            self.compressed_bytes += len(data)
+            self.compress_secs += time.perf_counter()-ti
+        return compressedFrame(data,img.shape,img.dtype,img.nbytes)
+
+    def counters(self):
+        ratio = self.raw_bytes/self.compressed_bytes if self.compressed_bytes > 0 else None
+        throughput = self.raw_bytes/self.compress_secs/1e6 if self.compress_secs > 0 else None
+        return {"codec":self.codec,"raw_bytes":self.raw_bytes,"compressed_bytes":self.compressed_bytes,"ratio":ratio,\
+                "MB_per_sec_per_thread":throughput}
+
+def write_frame(dataset,offsets,img):
+    ### Uncompressed frame-aligned chunks are written straight from the array buffer, skipping h5py's selection and conversion path ###
+    if isinstance(img,compressedFrame):
+        dataset.id.write_direct_chunk(offsets,img.data)
+    elif dataset.chunks == (1,)*(len(offsets)-2) + img.shape and dataset.compression is None and img.dtype == dataset.dtype and img.flags.c_contiguous:
+        dataset.id.write_direct_chunk(offsets,img)
+    else:
+        dataset[tuple(offsets[:-2])] = img
+
+class framePool:
+    def __init__(self,dtype=np.uint16,size=16):
+        ### pymmcore's getImage already returns a fresh array, so frames in the storage dtype are adopted without a copy ###
+        ### Anything else is converted once into a recycled buffer, which the writer hands back after the frame is on disk ###
+        self.dtype = np.dtype(dtype)
+        self.size = size
+        self.free = queue.Queue()
+        self.buffers = {}
+        self.adopted = 0
+        self.copied = 0
+
+    def get_buffer(self,shape):
+        while True:
+            try:
+                buffer = self.free.get_nowait()
+            except queue.Empty:
+                break
+            if buffer.shape == shape:
+                return buffer
+            del self.buffers[id(buffer)]
+        buffer = np.empty(shape,dtype=self.dtype)
+        self.buffers[id(buffer)] = buffer
+        return buffer
+
+    def preallocate(self,shape):
+        ### Tops the free list up to size buffers of this shape, dropping any left over from a different frame size ###
+        free = []
+        while not self.free.empty():
+            buffer = self.free.get_nowait()
+            if buffer.shape == shape:
+                free.append(buffer)
+            else:
+                del self.buffers[id(buffer)]
+        for buffer in free:
+            self.free.put(buffer)
+        for buffer_num in range(self.size - self.free.qsize()):
+            buffer = np.empty(shape,dtype=self.dtype)
+            self.buffers[id(buffer)] = buffer
+            self.free.put(buffer)
+
+    def take(self,img):
+        if img.dtype == self.dtype and img.flags.c_contiguous:
+            self.adopted += 1
+            return img
+        buffer = self.get_buffer(img.shape)
+        np.copyto(buffer,img,casting="unsafe")
+        self.copied += 1
+        return buffer
+
+    def release(self,img):
+        if id(img) in self.buffers and self.free.qsize() < self.size:
+            self.free.put(img)
+        elif id(img) in self.buffers:
+            del self.buffers[id(img)]
+
+    def counters(self):
+        return {"adopted":self.adopted,"copied":self.copied,"buffers":len(self.buffers)}
+
+def image_filename(output_folder,metadata_entry,timepoint):
+    return output_folder + "fov=" + str(metadata_entry["fov"]) + "_config=" + str(metadata_entry["config"]) + "_t=" + str(timepoint) + ".hdf5"
+
+class fileStore:
+    def __init__(self,output_folder="./",codec=None):
+        self.output_folder = output_folder
+        self.codec = codec
+
+    def write(self,img,metadata_entry,timepoint):
+        if self.codec is not None and not isinstance(img,compressedFrame):
+            img = self.codec.compress(img)
+        dataset_kwargs = {} if self.codec is None else self.codec.dataset_kwargs()
+        with h5py.File(image_filename(self.output_folder,metadata_entry,timepoint),"w") as h5pyfile:
+            hdf5_dataset = h5pyfile.create_dataset("data", shape=img.shape, chunks=img.shape, dtype='uint16', **dataset_kwargs)
+            write_frame(hdf5_dataset,(0,0),img)
+
+    def write_metadata(self,imgs_metadata,timepoint):
+        metadata = pd.DataFrame.from_dict(imgs_metadata)
+        metadata.to_hdf(self.output_folder + "metadata_" + str(timepoint) + ".hdf5", key="data", mode="w")
+
+    def write_snapshot(self,name,img):
+        with h5py.File(self.output_folder + name + ".hdf5","w") as h5pyfile:
+            hdf5_dataset = h5pyfile.create_dataset("data", shape=img.shape, chunks=img.shape, dtype='uint16')
+            write_frame(hdf5_dataset,(0,0),img)
+
+    def close(self):
+        pass
+
+metadata_dtype = np.dtype([("t","i4"),("fov","i4"),("channel","i4"),("x","f8"),("y","f8"),("z","f8"),("time","f8")])
+
+class runStore:
+    def __init__(self,path,channels=[],codec=None):
+        ### One resizable (t, fov, channel, y, x) dataset per run, chunked per frame, with a metadata table beside it ###
+        self.path = path
+        self.codec = codec
+        self.h5pyfile = h5py.File(path,"a")
+        if "data" in self.h5pyfile:
+            self.channels = json.loads(self.h5pyfile["data"].attrs["channels"])
+        else:
+            self.channels = []
+        for channel in channels:
+            self.channel_index(channel)
+        if "metadata" not in self.h5pyfile:
+            self.h5pyfile.create_dataset("metadata",shape=(0,),maxshape=(None,),dtype=metadata_dtype,chunks=(1024,))
+
+    def channel_index(self,config):
+        if config not in self.channels:
+            self.channels.append(config)
+            if "data" in self.h5pyfile:
+                self.h5pyfile["data"].attrs["channels"] = json.dumps(self.channels)
+        return self.channels.index(config)
+
+    def get_dataset(self,img):
+        if "data" not in self.h5pyfile:
+            y_dim,x_dim = img.shape
+            dataset_kwargs = {} if self.codec is None else self.codec.dataset_kwargs()
+            dataset = self.h5pyfile.create_dataset("data",shape=(0,0,len(self.channels),y_dim,x_dim),maxshape=(None,None,None,y_dim,x_dim),\
+                                                  chunks=(1,1,1,y_dim,x_dim),dtype='uint16',**dataset_kwargs)
+            dataset.attrs["channels"] = json.dumps(self.channels)
+        return self.h5pyfile["data"]
+
+    def write(self,img,metadata_entry,timepoint):
+        if self.codec is not None and not isinstance(img,compressedFrame):
+            img = self.codec.compress(img)
+        dataset = self.get_dataset(img)
+        fov = metadata_entry["fov"]
+        channel = self.channel_index(metadata_entry["config"])
+        shape = dataset.shape
+        new_shape = (max(shape[0],timepoint+1),max(shape[1],fov+1),max(shape[2],len(self.channels))) + shape[3:]
+        if new_shape != shape:
+            dataset.resize(new_shape)
+        write_frame(dataset,(timepoint,fov,channel,0,0),img)
+
+        metadata = self.h5pyfile["metadata"]
+        row = np.array([(timepoint,fov,channel,metadata_entry["x"],metadata_entry["y"],metadata_entry["z"],metadata_entry["t"])],dtype=metadata_dtype)
+        metadata.resize((metadata.shape[0]+1,))
+        metadata[-1] = row[0]
+
+    def write_metadata(self,imgs_metadata,timepoint):
+        self.h5pyfile.flush()
+
+    def write_snapshot(self,name,img):
+        if name in self.h5pyfile.require_group("snapshots"):
+            del self.h5pyfile["snapshots"][name]
+        snapshot = self.h5pyfile["snapshots"].create_dataset(name,shape=img.shape,chunks=img.shape,dtype='uint16')
+        write_frame(snapshot,(0,0),img)
+        self.h5pyfile.flush()
+
+    def close(self):
+        self.h5pyfile.close()
+
+def open_store(storage,output_folder="./",filename="run.hdf5",channels=[],compression=None):
+    codec = None if compression is None else frameCodec(compression)
+    if storage == "files":
+        return fileStore(output_folder,codec=codec)
+    elif storage == "consolidated":
+        return runStore(output_folder + filename,channels=channels,codec=codec)
+    else:
+        raise ValueError("Storage backend not recognized")
+
+class streamWriter:
+    def __init__(self,store,queue_size=8,profiler=None,on_write=None,pool=None,compress_threads=4):
+        ### Frames are handed off to a background thread; put() blocks once queue_size frames are waiting ###
+        ### With a compressing store, frames are compressed on a thread pool ahead of the writer, which keeps acquisition order ###
+        self.store = store
+        self.codec = getattr(store,"codec",None)
+        self.executor = ThreadPoolExecutor(max_workers=compress_threads) if self.codec is not None and compress_threads > 0 else None
+        self.t_start = time.perf_counter()
+        self.on_write = on_write
+        self.pool = pool
+        self.profiler = acqProfiler(enabled=False) if profiler is None else profiler
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.error = None
+        self.frames_written = 0
+        self.thread = threading.Thread(target=self.drain,daemon=True)
+        self.thread.start()
+
+    def drain(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if self.error is None:
+                try:
+                    img,frame,metadata_entry,timepoint = item
+                    if frame is not None:
+                        with self.profiler.phase("compress wait",fov=metadata_entry["fov"],config=metadata_entry["config"]):
+                            frame = frame.result()
+                    else:
+                        frame = img
+                    with self.profiler.phase("write",fov=metadata_entry["fov"],config=metadata_entry["config"]):
+                        self.store.write(frame,metadata_entry,timepoint)
+                    self.frames_written += 1
+                    if self.pool is not None:
+                        self.pool.release(img)
+                    if self.on_write is not None:
+                        self.on_write(metadata_entry,timepoint)
+                except Exception as e:
+                    self.error = e
+
+    def put(self,img,metadata_entry,timepoint):
+        if self.error is not None:
+            raise IOError("Background write failed.") from self.error
+        frame = None if self.executor is None else self.executor.submit(self.codec.compress,img)
+        self.queue.put((img,frame,metadata_entry,timepoint))
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.executor is not None:
+            self.executor.shutdown()
+        if self.error is not None:
+            raise IOError("Background write failed.") from self.error
+
+    def counters(self):
+        t_elapsed = time.perf_counter()-self.t_start
+        counters = {"frames_written":self.frames_written,"secs":t_elapsed}
+        if self.codec is not None:
+            counters.update(self.codec.counters())
+            counters["MB_per_sec"] = self.codec.raw_bytes/t_elapsed/1e6
+        return counters
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        self.close()
+
+def json_default(value):
+    if hasattr(value,"item"):
+        return value.item()
+    return str(value)
+
+class runJournal:
+    def __init__(self,path,resume=True):
+        ### Append-only JSON-lines log of completed steps and written frames; each entry is fsynced before the run moves on ###
+        self.path = path
+        self.lock = threading.Lock()
+        self.steps = {}
+        self.frames = {}
+        self.wait_starts = {}
+        if resume and os.path.exists(path):
+            self.replay()
+        self.outfile = open(path,"a" if resume else "w")
+
+    def replay(self):
+        with open(self.path,"r") as infile:
+            for line in infile:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    ### A crash can leave a truncated last line ###
+                    continue
+                if entry["kind"] == "step":
+                    self.steps[entry["key"]] = entry
+                elif entry["kind"] == "frame":
+                    self.frames[(entry["t"],entry["fov"],entry["config"])] = entry["metadata"]
+                elif entry["kind"] == "wait_start":
+                    self.wait_starts[entry["key"]] = entry["time"]
+
+    def record(self,entry):
+        entry["time"] = entry.get("time",time.time())
+        with self.lock:
+            self.outfile.write(json.dumps(entry,default=json_default) + "\n")
+            self.outfile.flush()
+            os.fsync(self.outfile.fileno())
+
+    def step_done(self,key):
+        return key in self.steps
+
+    def record_step(self,key,**values):
+        entry = {"kind":"step","key":key}
+        entry.update(values)
+        self.record(entry)
+        self.steps[key] = entry
+
+    def last_step(self):
+        if len(self.steps) == 0:
+            return None
+        return max(self.steps.values(),key=lambda entry: entry["time"])
+
+    def wait_started(self,key):
+        return self.wait_starts.get(key)
+
+    def record_wait_start(self,key):
+        self.wait_starts[key] = time.time()
+        self.record({"kind":"wait_start","key":key,"time":self.wait_starts[key]})
+
+    def record_frame(self,metadata_entry,timepoint):
+        self.record({"kind":"frame","t":timepoint,"fov":metadata_entry["fov"],"config":metadata_entry["config"],"metadata":metadata_entry})
+        self.frames[(timepoint,metadata_entry["fov"],metadata_entry["config"])] = metadata_entry
+
+    def completed_frames(self,timepoint):
+        return {(fov,config):metadata_entry for (t,fov,config),metadata_entry in self.frames.items() if t == timepoint}
+
+    def close(self):
+        self.outfile.close()